@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+RedisCache的协程版本, 给async视图使用, 需要redis>=4.2(redis.asyncio)
+
+和同步版本共用配置、key的命名、序列化格式、版本号、一级缓存、熔断器和统计, 两边读写的是同一份缓存,
+同步代码里的失效(包括CacheInvalidationProcessor)对协程版本同样有效。
+被装饰的函数是async def; 过期值交给同步版本的刷新线程, 在线程里用asyncio.run重新执行被装饰函数,
+所以被装饰函数不能依赖request, 也不能用参数里绑定在当前事件循环上的对象。
+"""
+import asyncio
+import random
+import threading
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+from functools import wraps
+from logging import getLogger
+
+from redis import RedisError
+
+from app.cache import (CacheOptions, CacheUnavailable, MISS, _BOUNDED_HSET, _Batch, _LockAttempts, _default_options,
+                       _is_none, _missing, cache)
+from app.errors import BaseError
+from app.redis_manager import redis_manager
+
+logger = getLogger(__name__)
+
+# 和redlock一样, 只删除自己加的锁
+_UNLOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class AsyncRedisCache(object):
+    """
+    key、选项、统计和一级缓存的簿记都用RedisCache上的方法, 这里只换成协程的读写
+    """
+
+    def __init__(self, redis_cache=None):
+        self.sync = redis_cache or cache
+        # 每个事件循环一份 {key: future}, 同一个循环里相同key的并发未命中只计算一次
+        self._flights = weakref.WeakKeyDictionary()
+        self._flights_lock = threading.Lock()
+        self._scripts = {}
+
+    def _redis(self):
+        db, overrides = self.sync.redis_params
+        return redis_manager.get_async(db, **overrides)
+
+    def _node(self, node_id):
+        db, overrides = self.sync.node_params[node_id]
+        return redis_manager.get_async(db, **overrides)
+
+    def _node_for(self, name):
+        return self._node(self.sync.ring.get_node_id(name))
+
+    def _script(self, client, source):
+        # 脚本对象只是缓存sha, 调用时传client, 可以跨事件循环共用
+        script = self._scripts.get(source)
+        if script is None:
+            script = self._scripts[source] = client.register_script(source)
+        return script
+
+    async def _generation(self, model):
+        sync = self.sync
+        generation = sync._known_generation(model)
+        if generation is None:
+            raw = await sync.breaker.call_async(self._redis().get, sync._generation_key(model))
+            generation = sync._remember_generation(model, raw)
+        return generation
+
+    async def _bump_generation(self, model):
+        client = self._redis()
+        generation = await client.incr(self.sync._generation_key(model))
+        await client.sadd(self.sync.retired_key, self.sync._retire_generation(model, generation))
+
+    async def _get_sorted_name(self, model, oid):
+        self.sync._check_name(model, oid)
+        return self.sync._format_name(model, oid, await self._generation(model))
+
+    async def _publish_invalidate(self, **message):
+        data = self.sync._local_invalidate(**message)
+        if data is not None:
+            await self._redis().publish(self.sync.channel, data)
+
+    async def _hset(self, client, name, hash_key, set_value):
+        """
+        client可以是节点也可以是pipeline
+        """
+        if not self.sync.bounded:
+            await client.hset(name, hash_key, set_value)
+            return
+        keys, args = self.sync._bounded_hset_params(name, hash_key, set_value)
+        await self._script(client, _BOUNDED_HSET)(keys=keys, args=args, client=client)
+
+    async def _load(self, name, hash_key):
+        return self.sync._decode(await self._get_raw(name, hash_key))
+
+    async def _get_raw(self, name, hash_key):
+        node = self._node_for(name)
+        if self.sync.bounded:
+            async with node.pipeline(transaction=False) as pipe:
+                self.sync._queue_reads(pipe, [(name, hash_key)])
+                raw = (await pipe.execute())[0]
+        else:
+            raw = await node.hget(name, hash_key)
+        return raw
+
+    async def _load_many(self, keys):
+        return [self.sync._decode(raw) for raw in await self._get_raw_many(keys)]
+
+    async def _get_raw_many(self, keys):
+        """
+        每个节点一个pipeline, 各节点并发读取, 返回没有解码的值
+        """
+        results = [None] * len(keys)
+
+        async def load(node_id, indexes):
+            async with self._node(node_id).pipeline(transaction=False) as pipe:
+                self.sync._queue_reads(pipe, [keys[index] for index in indexes])
+                for index, raw in zip(indexes, await pipe.execute()):
+                    results[index] = raw
+
+        groups = self.sync.ring.group([name for name, _ in keys])
+        await asyncio.gather(*(load(node_id, indexes) for node_id, indexes in groups.items()))
+        return results
+
+    async def _store(self, name, hash_key, value, serializer=None, ttl=None, stale_ttl=0, delta=0):
+        set_value = self.sync._encode(value, serializer, ttl, stale_ttl, delta)
+        if set_value is not None:
+            await self._write(name, hash_key, set_value)
+            return len(set_value)
+
+    async def _write(self, name, hash_key, set_value):
+        await self._hset(self._node_for(name), name, hash_key, set_value)
+
+    async def _store_many(self, items, serializer=None, ttl=None, options=None):
+        sizes, encoded = self.sync._encode_many(items, serializer, ttl, options)
+        await self._hset_many(encoded)
+        return sizes
+
+    async def _hset_many(self, items, names=()):
+        """
+        每个节点一个pipeline, 各节点并发执行: 先删除names, 再写入items [(name, hash_key, set_value)]
+        """
+
+        async def write(node_id, deleted, node_items):
+            async with self._node(node_id).pipeline(transaction=False) as pipe:
+                if deleted:
+                    pipe.delete(*deleted)
+                for item in node_items:
+                    await self._hset(pipe, *item)
+                await pipe.execute()
+
+        await asyncio.gather(*(write(*group) for group in self.sync._write_groups(items, names)))
+
+    async def get(self, model, oid, resource_type, params=None, default=MISS):
+        entry = await self._load(await self._get_sorted_name(model, oid),
+                                 self.sync._get_sorted_hash_key(resource_type, params))
+        return entry.value if entry.hit else default
+
+    async def get_many(self, model, oids, resource_type, params=None):
+        """
+        批量读取多个对象同一个方法的缓存, 只返回命中的{oid: value}
+        """
+        hash_key = self.sync._get_sorted_hash_key(resource_type, params)
+        names = [await self._get_sorted_name(model, oid) for oid in oids]
+        entries = await self._load_many([(name, hash_key) for name in names])
+        return {oid: entry.value for oid, entry in zip(oids, entries) if entry.hit}
+
+    async def set_many(self, model, values, resource_type, params=None, serializer=None, ttl=None):
+        hash_key = self.sync._get_sorted_hash_key(resource_type, params)
+        await self._store_many([(await self._get_sorted_name(model, oid), hash_key, value)
+                                for oid, value in values.items()], serializer, ttl)
+
+    async def delete(self, model, oid, resource_type=None, params=None):
+        if resource_type:
+            name = await self._get_sorted_name(model, oid)
+            hash_key = self.sync._get_sorted_hash_key(resource_type, params)
+            async with self._node_for(name).pipeline(transaction=False) as pipe:
+                pipe.hdel(name, hash_key)
+                if self.sync.bounded:
+                    pipe.zrem('%s:lru' % name, hash_key)
+                    pipe.zrem('%s:exp' % name, hash_key)
+                await pipe.execute()
+            await self._publish_invalidate(name=name, hash_key=hash_key)
+        elif oid:
+            name = await self._get_sorted_name(model, oid)
+            await self._node_for(name).delete(*self.sync._related_keys(name))
+            await self._publish_invalidate(name=name)
+        else:
+            await self._bump_generation(model)
+            await self._publish_invalidate(model=model)
+        logger.debug("删除缓存成功")
+
+    async def delete_many(self, keys):
+        """
+        删除多个(model, oid)的缓存, 每个节点一个pipeline
+        """
+        await self.write_through({await self._get_sorted_name(model, oid) for model, oid in keys})
+
+    async def write_through(self, names, items=()):
+        names = sorted(names)
+        if not names and not items:
+            return
+        await self._hset_many(items, names)
+        await self._publish_invalidate(names=names)
+        logger.debug(f"批量删除缓存成功:{len(names)}, 写入缓存:{len(items)}")
+
+    async def _lock(self, resource, ttl=None):
+        """
+        和同步版本的Redlock用同一个key, 两边互斥; 返回锁的token, 拿不到返回None
+        """
+        token = uuid.uuid4().hex
+        if await self._redis().set(resource, token, nx=True, px=ttl or self.sync.lock_ttl):
+            return token
+
+    async def _unlock(self, resource, token):
+        client = self._redis()
+        await self._script(client, _UNLOCK)(keys=[resource], args=[token], client=client)
+
+    @asynccontextmanager
+    async def lock(self, resource, ttl=None):
+        """
+        async with async_cache.lock('lock:xxx'): ...
+        按lock_retry和退避重试, 拿不到锁抛BaseError
+        """
+        delay = self.sync.lock_backoff
+        for _ in range(self.sync.lock_retry):
+            token = await self._lock(resource, ttl)
+            if token:
+                try:
+                    yield
+                finally:
+                    await self._unlock(resource, token)
+                return
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, self.sync.lock_backoff_max)
+        raise BaseError("获取锁失败")
+
+    async def _single_flight(self, key, fn, *args):
+        loop = asyncio.get_running_loop()
+        with self._flights_lock:
+            flights = self._flights.setdefault(loop, {})
+        future = flights.get(key)
+        if future is not None:
+            logger.debug(f'等待同进程计算结果:{key}')
+            return await asyncio.shield(future)
+        future = flights[key] = loop.create_future()
+        try:
+            result = await fn(*args)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有等待者时不报"exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            flights.pop(key, None)
+
+    async def _compute_and_store(self, name, hash_key, compute, options=_default_options):
+        start = time.monotonic()
+        response = await compute()
+        delta = time.monotonic() - start
+        ttl, stale_ttl = options.ttl_for(response)
+        set_value = self.sync._encode(response, options.serializer, ttl, stale_ttl, delta)
+        size = None
+        if set_value is not None:
+            try:
+                await self.sync.breaker.call_async(self._write, name, hash_key, set_value)
+                size = len(set_value)
+            except RedisError:
+                logger.warning(f'写入缓存失败:{name} {hash_key}', exc_info=True)
+        return self.sync._computed(name, hash_key, response, size, ttl, stale_ttl, delta)
+
+    async def _fill(self, name, hash_key, compute, options=_default_options):
+        """
+        同RedisCache._fill, 等锁时让出事件循环
+        """
+        attempts = _LockAttempts(self.sync, name, hash_key)
+        for attempt in attempts:
+            token = await self._lock(attempts.resource)
+            if token:
+                attempts.acquired()
+                try:
+                    if attempt > 1:
+                        entry = await self._load(name, hash_key)
+                        if entry.hit:
+                            return entry
+                    return await self._compute_and_store(name, hash_key, compute, options)
+                finally:
+                    await self._unlock(attempts.resource, token)
+
+            await asyncio.sleep(attempts.failed(attempt))
+            if not self.sync.breaker.allow():
+                raise CacheUnavailable()
+            entry = self.sync._decode(await self.sync.breaker.call_async(self._get_raw, name, hash_key))
+            if entry.hit:
+                return entry
+
+        raise BaseError("获取锁失败")
+
+    async def _refresh(self, name, hash_key, compute, options=_default_options):
+        resource = 'lock:%s:%s' % (name, hash_key)
+        token = await self._lock(resource)
+        if not token:
+            return None
+        try:
+            logger.debug(f'刷新缓存:{name} {hash_key}')
+            return await self._compute_and_store(name, hash_key, compute, options)
+        finally:
+            await self._unlock(resource, token)
+
+    def cache_with_id(self, table_model=None, id_field='oid', param_fields=None, local=True, serializer=None,
+                      ttl=None, stale_ttl=0, early_refresh=0, negative_ttl=None, is_negative=_is_none):
+        """
+        参数同RedisCache.cache_with_id, 被装饰的是async def
+        """
+        options = CacheOptions(serializer, ttl, stale_ttl, negative_ttl, is_negative)
+        sync = self.sync
+
+        def decorator(f):
+            @wraps(f)
+            async def wrapper(*args, **kwargs):
+                method_name = f.__name__
+                model, oid, params = sync._call_key(args, kwargs, table_model, id_field, param_fields)
+                if not oid:
+                    return await f(*args, **kwargs)
+
+                computed = []
+
+                async def compute():
+                    response = await f(*args, **kwargs)
+                    computed.append(response)
+                    return response
+
+                try:
+                    name = await self._get_sorted_name(model, oid)
+                    hash_key = sync._get_sorted_hash_key(method_name, params)
+                    use_local = local and sync.local is not None
+                    if use_local:
+                        result = sync._local_get(name, hash_key)
+                        if result is not _missing:
+                            return result
+
+                    if not sync.breaker.allow():
+                        raise CacheUnavailable()
+                    entry = sync._decode(await sync.breaker.call_async(self._get_raw, name, hash_key))
+                    sync.stats.incr(model, method_name, 'hit' if entry.hit else 'miss')
+                    if not entry.hit:
+                        entry = await self._single_flight((name, hash_key), self._fill, name, hash_key, compute,
+                                                          options)
+                    elif sync._needs_refresh(entry, early_refresh):
+                        if stale_ttl:
+                            sync._refresh_in_background(name, hash_key, lambda *a, **k: asyncio.run(f(*a, **k)),
+                                                        args, kwargs, options)
+                            return entry.value
+                        refreshed = await self._refresh(name, hash_key, compute, options)
+                        if refreshed is None:
+                            return entry.value
+                        entry = refreshed
+                except (RedisError, CacheUnavailable):
+                    sync._bypassed(model, oid, method_name)
+                    return computed[0] if computed else await compute()
+
+                if use_local:
+                    sync._remember(name, hash_key, entry, options)
+                return entry.value
+
+            wrapper.cache_options = options
+            return wrapper
+
+        return decorator
+
+    def cache_with_ids(self, table_model, ids_field='oids', param_fields=None, resource_type=None, local=True,
+                       serializer=None, ttl=None, negative_ttl=None):
+        """
+        参数同RedisCache.cache_with_ids, 被装饰的是async def, 返回{oid: value}
+        """
+        options = CacheOptions(serializer, ttl, 0, negative_ttl, _is_none)
+        sync = self.sync
+
+        def decorator(f):
+            @wraps(f)
+            async def wrapper(*args, **kwargs):
+                method_name = resource_type or f.__name__
+                oids = kwargs.get(ids_field)
+                if not oids:
+                    return await f(*args, **kwargs)
+                hash_key = sync._get_sorted_hash_key(method_name, sync._call_params(kwargs, ids_field, param_fields))
+                try:
+                    names = {oid: await self._get_sorted_name(table_model, oid) for oid in oids}
+                except (RedisError, CacheUnavailable):
+                    sync.stats.incr(table_model, method_name, 'bypass', len(oids))
+                    return await f(*args, **kwargs)
+
+                batch = _Batch(sync, table_model, method_name, hash_key, names, local, options)
+                pending = batch.from_local(oids)
+                misses = []
+                if pending:
+                    loaded = None
+                    if sync.breaker.allow():
+                        try:
+                            raws = await sync.breaker.call_async(self._get_raw_many, batch.keys(pending))
+                            loaded = [sync._decode(raw) for raw in raws]
+                        except RedisError:
+                            logger.warning(f'批量读取缓存失败:{table_model} {method_name}', exc_info=True)
+                    if loaded is None:
+                        batch.bypassed(pending)
+                        kwargs[ids_field] = pending
+                        batch.results.update(await f(*args, **kwargs) or {})
+                        return batch.results
+                    misses = batch.from_redis(pending, loaded)
+
+                if misses:
+                    kwargs[ids_field] = misses
+                    start = time.monotonic()
+                    items = batch.to_store(misses, await f(*args, **kwargs) or {}, time.monotonic() - start)
+                    sizes, encoded = sync._encode_many(items, options=options)
+                    try:
+                        await sync.breaker.call_async(self._hset_many, encoded)
+                    except RedisError:
+                        logger.warning(f'批量写入缓存失败:{table_model} {method_name}', exc_info=True)
+                        sizes = [None] * len(items)
+                    batch.stored(items, sizes)
+
+                return batch.results
+
+            return wrapper
+
+        return decorator
+
+async_cache = AsyncRedisCache()
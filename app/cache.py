@@ -7,19 +7,62 @@
 日期:16-10-18
 时间:上午11:42
 """
+import hashlib
+import json
+import math
+import os
 import pickle
+import random
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlparse
 from functools import wraps
 from logging import getLogger
 
 from flask_sqlalchemy import Model
-from redis import StrictRedis
+from redis import RedisError
 from redlock import Redlock
+from sqlalchemy import event
 
 # from zeroso.base.extensions.internal_rpc import compress
+from app import serializer as serializers
+from app.cache_stats import CacheStats, NullCacheStats
+from app.circuit_breaker import CircuitBreaker
+from app.database import AbstractBulkEventsProcessor, db, has_active_history
 from app.errors import BaseError
+from app.hash_ring import HashRing
+from app.redis_manager import redis_manager
 
 logger = getLogger(__name__)
 
+class _Missing(object):
+    def __repr__(self):
+        return '<cache MISS>'
+
+    def __bool__(self):
+        return False
+
+
+# 未命中的标记, 和None/0/[]这些合法的缓存值区分开
+MISS = _Missing()
+_missing = MISS
+
+# 带ttl的缓存值前面加上 0xfe + (软过期时间, 硬过期时间, 计算耗时), 和序列化的头不冲突
+_ENVELOPE = 0xfe
+_envelope_meta = struct.Struct('!ddd')
+
+
+def parse_node(node):
+    """
+    缓存节点配置, 支持 {'host': , 'port': , 'db': } 或者 redis://host:port/db
+    """
+    if isinstance(node, str):
+        url = urlparse(node)
+        node = {'host': url.hostname, 'port': url.port or 6379, 'db': int(url.path.strip('/') or 0)}
+    return node['host'], int(node.get('port', 6379)), int(node.get('db', 0))
+
 
 def get_params(kwargs, id_field, available_fields):
     params = {}
@@ -38,11 +81,368 @@ def get_params(kwargs, id_field, available_fields):
     return params
 
 
+class LocalCache(object):
+    """
+    进程内一级缓存(LRU), 挡在redis hash前面, 热点数据不走网络
+
+    注意: 命中时直接返回缓存的对象本身, 调用方不要修改返回值
+    """
+
+    def __init__(self, max_size=1024, max_bytes=64 * 1024 * 1024, ttl=5):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # (name, hash_key) -> (expire_at, size, value)
+        self._data = OrderedDict()
+        # name -> {hash_key}, 按对象失效时用
+        self._names = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def get(self, name, hash_key, default=None):
+        key = (name, hash_key)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return item[2]
+
+    def set(self, name, hash_key, value, size=0, expire_at=None):
+        """
+        expire_at: 缓存值自己的过期时间(time.time()), 一级缓存不能比它活得更久
+        """
+        ttl = self.ttl
+        if expire_at is not None:
+            ttl = min(ttl, expire_at - time.time())
+        if size > self.max_bytes or ttl <= 0:
+            return
+        key = (name, hash_key)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + ttl, size, value)
+            self._names.setdefault(name, set()).add(hash_key)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_size or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+        hash_keys = self._names.get(key[0])
+        if hash_keys is not None:
+            hash_keys.discard(key[1])
+            if not hash_keys:
+                del self._names[key[0]]
+
+    def invalidate(self, name, hash_key=None):
+        with self._lock:
+            if hash_key is not None:
+                if (name, hash_key) in self._data:
+                    self._remove((name, hash_key))
+            else:
+                for hash_key in list(self._names.get(name, ())):
+                    self._remove((name, hash_key))
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            for name in [name for name in self._names if name.startswith(prefix)]:
+                self.invalidate(name)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._names.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Entry(namedtuple('_Entry', 'value size expire_at stale_until delta')):
+    """
+    expire_at之后是过期值(stale), stale_until之后视为未命中
+    """
+
+    @property
+    def hit(self):
+        return self.value is not _missing and (self.stale_until is None or self.stale_until > time.time())
+
+    @property
+    def stale(self):
+        return self.expire_at is not None and self.expire_at <= time.time()
+
+    def should_refresh(self, beta):
+        """
+        XFetch: 离过期越近、计算越慢越容易提前刷新, 把刷新分散到过期之前
+        """
+        if not beta or self.expire_at is None:
+            return False
+        return time.time() - self.delta * beta * math.log(1.0 - random.random()) >= self.expire_at
+
+
+_miss = _Entry(_missing, 0, None, None, 0)
+
+
+def _is_none(value):
+    return value is None
+
+
+class CacheOptions(namedtuple('CacheOptions', 'serializer ttl stale_ttl negative_ttl is_negative')):
+    """
+    被装饰函数的缓存选项
+    negative_ttl: is_negative(value)为真的结果(默认是None, 即"不存在")单独用这个较短的ttl缓存
+    """
+
+    def ttl_for(self, value):
+        if self.negative_ttl and self.is_negative(value):
+            return self.negative_ttl, 0
+        return self.ttl, self.stale_ttl
+
+
+_default_options = CacheOptions(None, None, 0, None, _is_none)
+
+
+# 有上限的hash写入: 写入字段, 清理过期字段, 超过字段数按LRU淘汰, 超过model的字节预算淘汰最久没写的对象
+# KEYS: hash, 字段LRU(zset), 字段过期时间(zset), model字节数, model的对象LRU(zset), model每个对象的字节数(hash)
+# ARGV: field, value, now, deadline(0为不过期), max_fields(0为不限), max_bytes(0为不限), hash名
+# 淘汰对象时会访问KEYS以外的key, 只能用在单机redis上(分片由HashRing在客户端完成)
+# 字节数是近似值: 对象被delete或者版本号作废时不扣减, 等它被淘汰时按记录的大小扣回来
+_BOUNDED_HSET = """
+local function drop(field)
+    local size = redis.call('HSTRLEN', KEYS[1], field)
+    redis.call('HDEL', KEYS[1], field)
+    redis.call('ZREM', KEYS[2], field)
+    redis.call('ZREM', KEYS[3], field)
+    return size
+end
+local delta = string.len(ARGV[2]) - redis.call('HSTRLEN', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+if tonumber(ARGV[4]) > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[4], ARGV[1])
+else
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+for _, field in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[3])) do
+    delta = delta - drop(field)
+end
+local max_fields = tonumber(ARGV[5])
+if max_fields > 0 then
+    local excess = redis.call('ZCARD', KEYS[2]) - max_fields
+    if excess > 0 then
+        for _, field in ipairs(redis.call('ZRANGE', KEYS[2], 0, excess - 1)) do
+            delta = delta - drop(field)
+        end
+    end
+end
+redis.call('HINCRBY', KEYS[6], ARGV[7], delta)
+redis.call('ZADD', KEYS[5], ARGV[3], ARGV[7])
+local total = redis.call('INCRBY', KEYS[4], delta)
+local max_bytes = tonumber(ARGV[6])
+local evicted = 0
+while max_bytes > 0 and total > max_bytes and evicted < 16 do
+    local oldest = redis.call('ZRANGE', KEYS[5], 0, 0)[1]
+    if not oldest or oldest == ARGV[7] then
+        break
+    end
+    local size = tonumber(redis.call('HGET', KEYS[6], oldest) or '0')
+    redis.call('DEL', oldest, oldest .. ':lru', oldest .. ':exp')
+    redis.call('ZREM', KEYS[5], oldest)
+    redis.call('HDEL', KEYS[6], oldest)
+    total = redis.call('INCRBY', KEYS[4], -size)
+    evicted = evicted + 1
+end
+return evicted
+"""
+
+
+class CacheUnavailable(Exception):
+    """
+    redis熔断中, 调用方应该跳过缓存
+    """
+
+
+def _deadline(set_value):
+    """
+    带ttl的缓存值的硬过期时间, 没有ttl返回0
+    """
+    if set_value[0] != _ENVELOPE:
+        return 0
+    return _envelope_meta.unpack_from(set_value, 1)[1]
+
+
+def _pack(payload, ttl=None, stale_ttl=0, delta=0):
+    if not ttl:
+        return payload
+    now = time.time()
+    return bytes((_ENVELOPE,)) + _envelope_meta.pack(now + ttl, now + ttl + stale_ttl, delta) + payload
+
+
+def _unpack(raw):
+    if raw[0] != _ENVELOPE:
+        return _Entry(serializers.loads(raw), len(raw), None, None, 0)
+    expire_at, stale_until, delta = _envelope_meta.unpack_from(raw, 1)
+    return _Entry(serializers.loads(raw[1 + _envelope_meta.size:]), len(raw), expire_at, stale_until, delta)
+
+
+def _fresh_entry(value, size, ttl=None, stale_ttl=0, delta=0):
+    """
+    刚算出并写入的值, 过期时间和_pack写进去的一致
+    """
+    if not ttl:
+        return _Entry(value, size, None, None, delta)
+    now = time.time()
+    return _Entry(value, size, now + ttl, now + ttl + stale_ttl, delta)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _LockAttempts(object):
+    """
+    _fill按缓存key加锁时的重试节奏和统计, 同步和协程版本共用, 两边只是加锁、等待和读取的方式不同
+    """
+
+    def __init__(self, cache, name, hash_key):
+        self.cache = cache
+        self.resource = 'lock:%s:%s' % (name, hash_key)
+        self.model, self.method = cache._stat_key(name, hash_key)
+        self.delay = cache.lock_backoff
+        self.start = time.monotonic()
+
+    def __iter__(self):
+        for attempt in range(1, self.cache.lock_retry + 1):
+            self.cache.stats.incr(self.model, self.method, 'lock_attempts')
+            yield attempt
+
+    def acquired(self):
+        logger.debug("获取锁成功")
+        self.cache.stats.observe(self.model, self.method, 'lock_wait_ms', (time.monotonic() - self.start) * 1000)
+
+    def failed(self, attempt):
+        """
+        返回这次没拿到锁之后要等待的秒数
+        """
+        logger.debug(f'第{attempt}次获取锁失败')
+        self.cache.stats.incr(self.model, self.method, 'lock_failures')
+        wait = self.delay + random.uniform(0, self.delay)
+        self.delay = min(self.delay * 2, self.cache.lock_backoff_max)
+        return wait
+
+
+class _Batch(object):
+    """
+    cache_with_ids一次调用的簿记: 一级缓存、命中分类、要写回的项和统计,
+    同步和协程版本只负责读写redis和调用被装饰函数
+    """
+
+    def __init__(self, cache, model, method, hash_key, names, local, options):
+        self.cache = cache
+        self.model = model
+        self.method = method
+        self.hash_key = hash_key
+        self.names = names
+        self.local = local and cache.local is not None
+        self.options = options
+        self.results = {}
+
+    def _keep(self, oid, value):
+        # 开启negative_ttl时None表示"不存在", 结果里不包含
+        if not (self.options.negative_ttl and value is None):
+            self.results[oid] = value
+
+    def keys(self, oids):
+        return [(self.names[oid], self.hash_key) for oid in oids]
+
+    def from_local(self, oids):
+        """
+        先查一级缓存, 返回没命中的oid
+        """
+        if not self.local:
+            return list(oids)
+        self.cache._ensure_listener()
+        pending = []
+        for oid in oids:
+            value = self.cache.local.get(self.names[oid], self.hash_key, _missing)
+            if value is _missing:
+                pending.append(oid)
+            else:
+                self._keep(oid, value)
+        self.cache.stats.incr(self.model, self.method, 'local_hit', len(oids) - len(pending))
+        return pending
+
+    def from_redis(self, oids, entries):
+        """
+        收下redis里命中的结果, 返回没命中或者已经过期的oid
+        """
+        misses = []
+        for oid, entry in zip(oids, entries):
+            if not entry.hit or entry.stale:
+                misses.append(oid)
+                continue
+            self._keep(oid, entry.value)
+            if self.local:
+                self.cache._remember(self.names[oid], self.hash_key, entry, self.options)
+        self.cache.stats.incr(self.model, self.method, 'hit', len(oids) - len(misses))
+        self.cache.stats.incr(self.model, self.method, 'miss', len(misses))
+        return misses
+
+    def bypassed(self, oids):
+        # redis不可用, 未命中一级缓存的全部直接计算, 也不写回
+        self.cache.stats.incr(self.model, self.method, 'bypass', len(oids))
+
+    def to_store(self, misses, computed, delta):
+        """
+        收下被装饰函数算出的结果, 返回要写回的[(name, hash_key, value)]
+        """
+        logger.debug(f'批量缓存未命中:{misses}')
+        self.cache.stats.observe(self.model, self.method, 'fill_ms', delta * 1000)
+        self.results.update({oid: computed[oid] for oid in misses if oid in computed})
+        if self.options.negative_ttl:
+            return [(self.names[oid], self.hash_key, computed.get(oid)) for oid in misses]
+        return [(self.names[oid], self.hash_key, computed[oid]) for oid in misses if oid in computed]
+
+    def stored(self, items, sizes):
+        for (name, hash_key, value), size in zip(items, sizes):
+            if size is None:
+                continue
+            self.cache.stats.observe(self.model, self.method, 'size', size)
+            if self.local:
+                self.cache._remember(name, hash_key, _fresh_entry(value, size, self.options.ttl_for(value)[0]),
+                                     self.options)
+
+
 class RedisCache(object):
     redis = None
+    pubsub_redis = None
+    ring = None
+    bounded = False
+    breaker = None
+    serializer = serializers.Serializer()
+    stats = NullCacheStats()
+    local = None
+    channel = None
     _instance = None
     _initialized = False
     _is_cached_on = False
+    _listener_pid = None
+    retired_key = 'cache:gen:retired'
+    hash_key_max_length = 64
 
     def __init__(self, app=None):
         if app is not None:
@@ -52,19 +452,64 @@ class RedisCache(object):
         self.app = app
         if not self._initialized:
             logger.info('Redis Cache Started')
-            url = 'redis://%s:%s/%s' % (app.config['REDIS_HOST'], app.config['REDIS_PORT'], app.config['REDIS_CACHE_DB'])
-            self.redis = StrictRedis.from_url(url)
+            # 缓存读写用较短的超时, redis慢的时候尽快失败, 交给熔断器降级
+            timeouts = {k: app.config[c] for k, c in (('socket_timeout', 'REDIS_CACHE_SOCKET_TIMEOUT'),
+                                                      ('socket_connect_timeout', 'REDIS_CACHE_CONNECT_TIMEOUT'))
+                        if app.config.get(c) is not None}
+            self.redis_params = (app.config['REDIS_CACHE_DB'], timeouts)
+            self.redis = redis_manager.get(app.config['REDIS_CACHE_DB'], **timeouts)
+            # 订阅是长连接, 不能用短超时
+            self.pubsub_redis = redis_manager.get(app.config['REDIS_CACHE_DB'])
+            # 对象的缓存hash按名字一致性哈希分到各个节点; 版本号、锁、统计和订阅都在主节点上
+            # node_params记下每个节点的连接参数, 协程版本按同样的节点建连接
+            self.node_params = {}
+            for node in app.config.get('REDIS_CACHE_NODES') or []:
+                host, port, db = parse_node(node)
+                self.node_params['%s:%s/%s' % (host, port, db)] = (db, dict(host=host, port=port, **timeouts))
+            if not self.node_params:
+                self.node_params['primary'] = self.redis_params
+            self.ring = HashRing({node_id: redis_manager.get(db, **overrides)
+                                  for node_id, (db, overrides) in self.node_params.items()})
+            # 单个对象hash的字段数上限和每个model的字节预算(整数或者{model: 字节数}), 预算平均分到每个节点
+            self.max_fields = app.config.get('REDIS_CACHE_MAX_FIELDS', 0)
+            self.model_max_bytes = app.config.get('REDIS_CACHE_MODEL_MAX_BYTES', 0)
+            self.bounded = bool(self.max_fields or self.model_max_bytes)
+            self.lru_touch_rate = app.config.get('REDIS_CACHE_LRU_TOUCH_RATE', 0.1)
+            self._bounded_hset_script = self.redis.register_script(_BOUNDED_HSET)
+            self.breaker = CircuitBreaker('redis_cache',
+                                          failure_threshold=app.config.get('REDIS_CACHE_BREAKER_FAILURES', 5),
+                                          slow_threshold=app.config.get('REDIS_CACHE_BREAKER_SLOW', 0.05),
+                                          reset_timeout=app.config.get('REDIS_CACHE_BREAKER_RESET', 5),
+                                          errors=(RedisError,))
             self._initialized = True
             self._is_cached_on = app.config.get('REDIS_CACHE_ON', False)
-            self.lock = Redlock([{'host': app.config['REDIS_HOST'], 'port': app.config['REDIS_PORT'], 'db': app.config['REDIS_CACHE_DB']}])
+            self.serializer = serializers.Serializer.from_config(app.config, 'REDIS_CACHE')
+            if app.config.get('REDIS_CACHE_STATS_ON', False):
+                self.stats = CacheStats(self.redis, app.config.get('REDIS_CACHE_STATS_FLUSH_INTERVAL', 10))
+            # 重试和退避由_fill控制, Redlock本身只尝试一次(retry_delay传0会被替换成默认值)
+            self.lock = Redlock([self.redis], retry_count=1, retry_delay=0.001)
+            self.lock_ttl = app.config.get('REDIS_CACHE_LOCK_TTL', 15000)
+            self.lock_retry = app.config.get('REDIS_CACHE_LOCK_RETRY', 10)
+            self.lock_backoff = app.config.get('REDIS_CACHE_LOCK_BACKOFF', 0.01)
+            self.lock_backoff_max = app.config.get('REDIS_CACHE_LOCK_BACKOFF_MAX', 0.5)
+            self._flights = {}
+            self._flights_lock = threading.Lock()
+            self._refreshing = set()
+            self._generations = {}
+            self.generation_ttl = app.config.get('REDIS_CACHE_GENERATION_TTL', 1)
+            self.hash_key_max_length = app.config.get('REDIS_CACHE_HASH_KEY_MAX_LENGTH', 64)
+            self.channel = app.config.get('REDIS_CACHE_CHANNEL', 'cache:invalidate')
+            if app.config.get('REDIS_CACHE_LOCAL_ON', False):
+                self.local = LocalCache(max_size=app.config.get('REDIS_CACHE_LOCAL_MAX_SIZE', 1024),
+                                        max_bytes=app.config.get('REDIS_CACHE_LOCAL_MAX_BYTES', 64 * 1024 * 1024),
+                                        ttl=app.config.get('REDIS_CACHE_LOCAL_TTL', 5))
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(RedisCache, cls).__new__(cls)
         return cls._instance
 
-    @staticmethod
-    def _get_sorted_hash_key(resource_type, params):
+    def _get_sorted_hash_key(self, resource_type, params):
         if not resource_type:
             raise Exception('Resource Type is not allow none or empty')
 
@@ -75,115 +520,845 @@ class RedisCache(object):
         sorted_params = [(k, params[k]) for k in sorted(params.keys())]
         sorted_params_string = ('?' + '&'.join(['%s=%s' % (_[0], _[1]) for _ in sorted_params])) if sorted_params else ''
 
+        # 参数太长时只保留方法名, 参数部分换成定长摘要, 节省内存
+        if len(sorted_params_string) > self.hash_key_max_length:
+            digest = hashlib.blake2b(sorted_params_string.encode('utf8'), digest_size=16).hexdigest()
+            sorted_params_string = '#' + digest
+
         return '%s%s' % (resource_type, sorted_params_string)
 
+    def _get_sorted_name(self, model, oid):
+        self._check_name(model, oid)
+        return self._format_name(model, oid, self._generation(model))
+
     @staticmethod
-    def _get_sorted_name(model, oid):
+    def _check_name(model, oid):
         if not model:
             raise Exception('no model defined!')
         if not oid:
             raise Exception('no oid defined!')
-        return '%s:%s' % (model, oid)
 
-    def _set(self, model, oid, resource_type, params=None, value=None):
-        name = self._get_sorted_name(model, oid)
-        hash_key = self._get_sorted_hash_key(resource_type, params)
+    @staticmethod
+    def _format_name(model, oid, generation):
+        return '%s:g%s:%s' % (model, generation, oid)
+
+    @staticmethod
+    def _generation_key(model):
+        return 'cache:gen:%s' % model
+
+    def _generation(self, model):
+        """
+        model的缓存版本号, 整个model失效只需要INCR版本号
+        本地缓存generation_ttl秒, 开启一级缓存时收到失效消息会立即刷新
+        """
+        generation = self._known_generation(model)
+        if generation is None:
+            generation = self._remember_generation(model, self.breaker.call(self.redis.get,
+                                                                            self._generation_key(model)))
+        return generation
+
+    def _known_generation(self, model):
+        """
+        本地缓存的版本号, 需要从redis读取时返回None
+        """
+        item = self._generations.get(model)
+        if item is not None and item[1] >= time.monotonic():
+            return item[0]
+        if not self.breaker.allow():
+            # 熔断期间沿用已知的版本号, 一级缓存还能继续用
+            if item is None:
+                raise CacheUnavailable()
+            return item[0]
+        return None
+
+    def _remember_generation(self, model, raw):
+        generation = int(raw or 0)
+        self._generations[model] = (generation, time.monotonic() + self.generation_ttl)
+        return generation
+
+    def _bump_generation(self, model):
+        generation = self.redis.incr(self._generation_key(model))
+        self.redis.sadd(self.retired_key, self._retire_generation(model, generation))
+
+    def _retire_generation(self, model, generation):
+        """
+        INCR之后调用, 返回旧版本的前缀: 旧版本的key不再被读到, 交给sweep回收
+        """
+        self._generations.pop(model, None)
+        return '%s:g%s' % (model, int(generation) - 1)
+
+    def sweep(self, count=1000):
+        """
+        SCAN回收已经失效的旧版本key, 返回删除的key数量
+        """
+        deleted = 0
+        for prefix in self.redis.smembers(self.retired_key):
+            prefix = prefix.decode('utf8')
+            for node in self.ring.nodes.values():
+                batch = []
+                for key in node.scan_iter(match='%s:*' % prefix, count=count):
+                    batch.append(key)
+                    if len(batch) >= count:
+                        deleted += node.unlink(*batch)
+                        batch = []
+                if batch:
+                    deleted += node.unlink(*batch)
+            self.redis.srem(self.retired_key, prefix)
+            logger.info(f'回收旧版本缓存:{prefix}')
+        return deleted
+
+    def _ensure_listener(self):
+        """
+        一级缓存的失效订阅线程, 按进程启动, fork后的worker会重新订阅
+        """
+        if self.local is None or self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+        self.local.clear()
+        listener = threading.Thread(target=self._listen, name='cache-invalidate', daemon=True)
+        listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.pubsub_redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # 断线期间可能漏掉失效消息
+                self.local.clear()
+                for message in pubsub.listen():
+                    self._on_invalidate(message['data'])
+            except Exception:
+                logger.exception('缓存失效订阅断开, 1秒后重连')
+                self.local.clear()
+                time.sleep(1)
+
+    def _on_invalidate(self, data):
         try:
-            set_value = pickle.dumps(value)
-        except (pickle.PickleError, TypeError, AttributeError):
-            logger.exception("pickle dumps data error")
-            logger.error(f'缓存dumps出错, value为{value}')
+            message = json.loads(data)
+        except (TypeError, ValueError):
+            logger.error(f'无法解析的缓存失效消息:{data}')
+            return
+        if 'model' in message:
+            self._generations.pop(message['model'], None)
+            self.local.invalidate_prefix('%s:' % message['model'])
+        elif 'names' in message:
+            for name in message['names']:
+                self.local.invalidate(name)
         else:
-            self.redis.hset(name, hash_key, set_value)
+            self.local.invalidate(message['name'], message.get('hash_key'))
+
+    def _publish_invalidate(self, **message):
+        data = self._local_invalidate(**message)
+        if data is not None:
+            self.redis.publish(self.channel, data)
+
+    def _local_invalidate(self, **message):
+        """
+        本进程立即失效, 返回要广播给其他worker和节点的消息, 没有开启一级缓存时返回None
+        """
+        if self.local is None:
+            return None
+        data = json.dumps(message)
+        self._on_invalidate(data)
+        return data
+
+    def _dumps(self, value, serializer=None):
+        try:
+            return (serializer or self.serializer).dumps(value)
+        except (pickle.PickleError, TypeError, ValueError, AttributeError):
+            logger.exception("serializer dumps data error")
+            logger.error(f'缓存dumps出错, value为{value}')
+
+    def _encode(self, value, serializer=None, ttl=None, stale_ttl=0, delta=0):
+        """
+        序列化并加上ttl信息, 序列化失败返回None
+        """
+        set_value = self._dumps(value, serializer)
+        if set_value is not None:
+            return _pack(set_value, ttl, stale_ttl, delta)
+
+    def _store(self, name, hash_key, value, serializer=None, ttl=None, stale_ttl=0, delta=0):
+        """
+        写入缓存, 返回序列化后的长度, 序列化失败返回None
+        """
+        set_value = self._encode(value, serializer, ttl, stale_ttl, delta)
+        if set_value is not None:
+            self._write(name, hash_key, set_value)
             logger.debug(f'设置缓存:hash_key:{hash_key},value:{value}')
+            return len(set_value)
 
-    def _get(self, model, oid, resource_type, params=None):
+    def _write(self, name, hash_key, set_value):
+        self._hset(self.ring.get(name), name, hash_key, set_value)
+
+    def _related_keys(self, name):
+        return [name, '%s:lru' % name, '%s:exp' % name] if self.bounded else [name]
+
+    def _model_max_bytes(self, model):
+        max_bytes = self.model_max_bytes
+        if isinstance(max_bytes, dict):
+            max_bytes = max_bytes.get(model, 0)
+        return int(max_bytes / len(self.ring)) if max_bytes else 0
+
+    def _hset(self, client, name, hash_key, set_value):
+        """
+        client可以是节点也可以是pipeline
+        """
+        if not self.bounded:
+            client.hset(name, hash_key, set_value)
+            return
+        keys, args = self._bounded_hset_params(name, hash_key, set_value)
+        self._bounded_hset_script(keys=keys, args=args, client=client)
+
+    def _bounded_hset_params(self, name, hash_key, set_value):
+        model = name.split(':', 1)[0]
+        keys = self._related_keys(name) + ['cache:bytes:%s' % model, 'cache:objs:%s' % model,
+                                           'cache:sizes:%s' % model]
+        args = [hash_key, set_value, time.time(), _deadline(set_value), self.max_fields,
+                self._model_max_bytes(model), name]
+        return keys, args
+
+    def _touch(self, pipe, name, hash_key):
+        """
+        按比例抽样更新LRU, 命中时不用每次都多一次写
+        """
+        if self.bounded and random.random() < self.lru_touch_rate:
+            now = time.time()
+            pipe.zadd('%s:lru' % name, {hash_key: now}, xx=True)
+            pipe.zadd('cache:objs:%s' % name.split(':', 1)[0], {name: now}, xx=True)
+
+    @staticmethod
+    def _decode(raw):
+        """
+        序列化后不会是空串, HGET返回None就是未命中, 不需要再HEXISTS
+        """
+        if raw is None:
+            return _miss
+        return _unpack(raw)
+
+    def _load(self, name, hash_key):
+        """
+        读取缓存, 返回_Entry
+        """
+        return self._decode(self._get_raw(name, hash_key))
+
+    def _load_many(self, keys):
+        """
+        读取多个(name, hash_key), 返回[_Entry]
+        """
+        return [self._decode(raw) for raw in self._get_raw_many(keys)]
+
+    def _get_raw_many(self, keys):
+        """
+        每个节点一个pipeline读取多个(name, hash_key), 返回没有解码的值
+        """
+        results = [None] * len(keys)
+        for node_id, indexes in self.ring.group([name for name, _ in keys]).items():
+            pipe = self.ring.nodes[node_id].pipeline(transaction=False)
+            self._queue_reads(pipe, [keys[index] for index in indexes])
+            for index, raw in zip(indexes, pipe.execute()):
+                results[index] = raw
+        return results
+
+    def _queue_reads(self, pipe, keys):
+        """
+        往pipeline里加入读取keys [(name, hash_key)]的命令, 执行结果的前len(keys)项是读到的值
+        """
+        for name, hash_key in keys:
+            pipe.hget(name, hash_key)
+        for name, hash_key in keys:
+            self._touch(pipe, name, hash_key)
+
+    def _store_many(self, items, serializer=None, ttl=None, options=None):
+        """
+        每个节点一个pipeline写入多个(name, hash_key, value), 返回每一项序列化后的长度
+        传了options时按options计算每一项的ttl
+        """
+        sizes, encoded = self._encode_many(items, serializer, ttl, options)
+        self._hset_many(encoded)
+        return sizes
+
+    def _encode_many(self, items, serializer=None, ttl=None, options=None):
+        """
+        序列化[(name, hash_key, value)], 返回(每一项序列化后的长度, 序列化成功的[(name, hash_key, set_value)])
+        """
+        sizes = []
+        encoded = []
+        for name, hash_key, value in items:
+            if options is not None:
+                serializer = options.serializer
+                ttl, _ = options.ttl_for(value)
+            set_value = self._encode(value, serializer, ttl)
+            sizes.append(None if set_value is None else len(set_value))
+            if set_value is not None:
+                encoded.append((name, hash_key, set_value))
+        return sizes, encoded
+
+    def _hset_many(self, items, names=()):
+        """
+        按节点分组, 每个节点一个pipeline: 先删除names, 再写入items [(name, hash_key, set_value)]
+        """
+        for node_id, deleted, node_items in self._write_groups(items, names):
+            pipe = self.ring.nodes[node_id].pipeline(transaction=False)
+            if deleted:
+                pipe.delete(*deleted)
+            for item in node_items:
+                self._hset(pipe, *item)
+            pipe.execute()
+
+    def _write_groups(self, items, names=()):
+        """
+        按节点分组, 返回[(node_id, 要删除的key, 要写入的items)]
+        """
+        names = list(names)
+        keys = names + [name for name, _, _ in items]
+        groups = []
+        for node_id, indexes in self.ring.group(keys).items():
+            deleted = [key for index in indexes if index < len(names) for key in self._related_keys(keys[index])]
+            groups.append((node_id, deleted, [items[index - len(names)] for index in indexes if index >= len(names)]))
+        return groups
+
+    def _set(self, model, oid, resource_type, params=None, value=None, serializer=None, ttl=None):
         name = self._get_sorted_name(model, oid)
         hash_key = self._get_sorted_hash_key(resource_type, params)
+        self._store(name, hash_key, value, serializer, ttl)
+
+    def _get_raw(self, name, hash_key):
         logger.debug(f'hash_key={hash_key}')
-        result = self.redis.hget(name, hash_key)
+        if self.bounded:
+            pipe = self.ring.get(name).pipeline(transaction=False)
+            self._queue_reads(pipe, [(name, hash_key)])
+            result = pipe.execute()[0]
+        else:
+            result = self.ring.get(name).hget(name, hash_key)
         logger.debug(result)
-        return pickle.loads(result) if result else result
+        return result
+
+    def _get(self, model, oid, resource_type, params=None):
+        name = self._get_sorted_name(model, oid)
+        hash_key = self._get_sorted_hash_key(resource_type, params)
+        entry = self._load(name, hash_key)
+        return entry.value if entry.hit else None
+
+    def get(self, model, oid, resource_type, params=None, default=MISS):
+        """
+        读取缓存, 未命中返回default, 缓存的None/0/[]原样返回
+        """
+        entry = self._load(self._get_sorted_name(model, oid), self._get_sorted_hash_key(resource_type, params))
+        return entry.value if entry.hit else default
+
+    def get_many(self, model, oids, resource_type, params=None):
+        """
+        批量读取多个对象同一个方法的缓存, 只返回命中的{oid: value}
+        """
+        hash_key = self._get_sorted_hash_key(resource_type, params)
+        names = [self._get_sorted_name(model, oid) for oid in oids]
+        return {oid: entry.value for oid, entry in zip(oids, self._load_many([(name, hash_key) for name in names]))
+                if entry.hit}
+
+    def set_many(self, model, values, resource_type, params=None, serializer=None, ttl=None):
+        """
+        批量写入{oid: value}, 一个pipeline完成
+        """
+        hash_key = self._get_sorted_hash_key(resource_type, params)
+        self._store_many([(self._get_sorted_name(model, oid), hash_key, value) for oid, value in values.items()],
+                         serializer, ttl)
 
     def _exists(self, model, oid, resource_type, params=None):
         name = self._get_sorted_name(model, oid)
         hash_key = self._get_sorted_hash_key(resource_type, params)
-        return self.redis.hexists(name, hash_key)
+        return self.ring.get(name).hexists(name, hash_key)
+
+    def _single_flight(self, key, fn, *args):
+        """
+        同一进程内相同key的并发未命中只计算一次, 其余调用等待并复用结果
+        """
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            logger.debug(f'等待同进程计算结果:{key}')
+            return flight.wait()
+        try:
+            flight.result = fn(*args)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    @staticmethod
+    def _stat_key(name, hash_key):
+        """
+        从缓存key还原(model, method)
+        """
+        return name.split(':', 1)[0], hash_key.split('?', 1)[0].split('#', 1)[0]
+
+    def _compute_and_store(self, name, hash_key, compute, options=_default_options):
+        start = time.monotonic()
+        response = compute()
+        delta = time.monotonic() - start
+        # 根据缓存的函数返回值, 写入到缓存中
+        ttl, stale_ttl = options.ttl_for(response)
+        # 序列化和压缩是CPU开销, 不算进redis的耗时, 熔断器只包住写入
+        set_value = self._encode(response, options.serializer, ttl, stale_ttl, delta)
+        size = None
+        if set_value is not None:
+            try:
+                self.breaker.call(self._write, name, hash_key, set_value)
+                size = len(set_value)
+            except RedisError:
+                logger.warning(f'写入缓存失败:{name} {hash_key}', exc_info=True)
+        return self._computed(name, hash_key, response, size, ttl, stale_ttl, delta)
+
+    def _computed(self, name, hash_key, response, size, ttl=None, stale_ttl=0, delta=0):
+        """
+        记录计算耗时和写入的大小, 返回_Entry, 没写进redis时size为None
+        """
+        model, method = self._stat_key(name, hash_key)
+        self.stats.observe(model, method, 'fill_ms', delta * 1000)
+        if size is not None:
+            self.stats.observe(model, method, 'size', size)
+        return _fresh_entry(response, size, ttl, stale_ttl, delta)
+
+    def _fill(self, name, hash_key, compute, options=_default_options):
+        """
+        按缓存key加锁计算并写入, 拿不到锁的进程退避等待持锁者写入的结果, 返回_Entry
+        """
+        attempts = _LockAttempts(self, name, hash_key)
+        for attempt in attempts:
+            cache_lock = self.lock.lock(attempts.resource, self.lock_ttl)
+            if cache_lock:
+                attempts.acquired()
+                try:
+                    # 等锁期间持锁者可能已经写入
+                    if attempt > 1:
+                        entry = self._load(name, hash_key)
+                        if entry.hit:
+                            return entry
+                    return self._compute_and_store(name, hash_key, compute, options)
+                finally:
+                    self.lock.unlock(cache_lock)
+                    logger.debug("释放锁成功")
+
+            time.sleep(attempts.failed(attempt))
+            if not self.breaker.allow():
+                raise CacheUnavailable()
+            entry = self._decode(self.breaker.call(self._get_raw, name, hash_key))
+            if entry.hit:
+                return entry
+
+        raise BaseError("获取锁失败")
+
+    def _refresh(self, name, hash_key, compute, options=_default_options):
+        """
+        提前刷新或过期后刷新, 只尝试一次锁, 拿不到说明别的进程正在刷新, 返回None
+        """
+        cache_lock = self.lock.lock('lock:%s:%s' % (name, hash_key), self.lock_ttl)
+        if not cache_lock:
+            return None
+        try:
+            logger.debug(f'刷新缓存:{name} {hash_key}')
+            return self._compute_and_store(name, hash_key, compute, options)
+        finally:
+            self.lock.unlock(cache_lock)
+
+    def _refresh_in_background(self, name, hash_key, call, args, kwargs, options=_default_options):
+        """
+        在后台线程用call(*args, **kwargs)刷新, 同一进程同一个key同时只有一个刷新
+        后台线程只有app context没有request context, 被装饰函数不能依赖request;
+        model的方法不能用请求里的对象(session按线程划分), 在后台线程里按id重新加载, 已经删除时不刷新
+        """
+        key = (name, hash_key)
+        with self._flights_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        model_class = None
+        if args and isinstance(args[0], Model):
+            model_class, oid, args = type(args[0]), args[0].id, args[1:]
+
+        def run():
+            try:
+                with self.app.app_context():
+                    call_args = args
+                    if model_class is not None:
+                        obj = model_class.query.get(oid)
+                        if obj is None:
+                            return
+                        call_args = (obj,) + args
+                    self._refresh(name, hash_key, lambda: call(*call_args, **kwargs), options)
+            except Exception:
+                logger.exception(f'后台刷新缓存失败:{name} {hash_key}')
+            finally:
+                with self._flights_lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name='cache-refresh', daemon=True).start()
 
     def delete(self, model, oid, resource_type=None, params=None):
         if resource_type:
             name = self._get_sorted_name(model, oid)
             hash_key = self._get_sorted_hash_key(resource_type, params)
-            self.redis.hdel(name, hash_key)
+            node = self.ring.get(name)
+            node.hdel(name, hash_key)
+            if self.bounded:
+                node.zrem('%s:lru' % name, hash_key)
+                node.zrem('%s:exp' % name, hash_key)
+            self._publish_invalidate(name=name, hash_key=hash_key)
         elif oid:
             name = self._get_sorted_name(model, oid)
-            self.redis.delete(name)
+            self.ring.get(name).delete(*self._related_keys(name))
+            self._publish_invalidate(name=name)
         else:
-            # get key list
-            self.redis.delete(self.redis.scan('%s:*'))
+            self._bump_generation(model)
+            self._publish_invalidate(model=model)
         logger.debug("删除缓存成功")
 
+    def delete_many(self, keys):
+        """
+        一个pipeline删除多个(model, oid)的缓存
+        """
+        self.write_through({self._get_sorted_name(model, oid) for model, oid in keys})
+
+    def write_through(self, names, items=()):
+        """
+        每个节点一个pipeline, 先删除names对应的缓存, 再写入items [(name, hash_key, set_value)]
+        """
+        names = sorted(names)
+        if not names and not items:
+            return
+        self._hset_many(items, names)
+        self._publish_invalidate(names=names)
+        logger.debug(f"批量删除缓存成功:{len(names)}, 写入缓存:{len(items)}")
+
     def expire(self, model, oid, time=1):
         if not oid:
-            self.redis.delete(self.redis.scan('%s:*'))
+            # 整个model只能通过版本号立即失效
+            self._bump_generation(model)
+            self._publish_invalidate(model=model)
+            return
         name = self._get_sorted_name(model, oid)
 
-        if self.redis.ttl(name) < 0:
-            self.redis.expire(name, time)
+        node = self.ring.get(name)
+        if node.ttl(name) < 0:
+            node.expire(name, time)
+        self._publish_invalidate(name=name)
 
         logger.debug(f"设置缓存过期{time}")
 
-    def cache_with_id(self, table_model=None, id_field='oid', param_fields=None, is_grpc=False):
+    def _call_params(self, kwargs, id_field, param_fields=None):
+        # if no param_fields defined, use all params except id_field
+        return get_params(kwargs, id_field, param_fields or kwargs.keys())
+
+    def _call_key(self, args, kwargs, table_model, id_field, param_fields=None):
+        """
+        被装饰函数一次调用对应的(model, oid, params), oid为空时不走缓存
+        """
+        if args and isinstance(args[0], Model):
+            model, oid = args[0].__tablename__, args[0].id
+        else:
+            model, oid = table_model, kwargs.get(id_field, None)
+        if not oid:
+            return model, oid, None
+        return model, oid, self._call_params(kwargs, id_field, param_fields)
+
+    def _local_get(self, name, hash_key):
+        self._ensure_listener()
+        result = self.local.get(name, hash_key, _missing)
+        if result is not _missing:
+            self.stats.incr(*self._stat_key(name, hash_key), 'local_hit')
+        return result
+
+    def _remember(self, name, hash_key, entry, options=_default_options):
+        """
+        把从redis读到或者刚写入redis的值放进一级缓存, 没写进redis的(size为None)不放
+        一级缓存最多活到值的软过期时间; negative_ttl比一级缓存还短的"不存在"不放, 对象创建后马上能查到
+        """
+        if entry.size is None:
+            return
+        if options.negative_ttl and options.negative_ttl < self.local.ttl and options.is_negative(entry.value):
+            return
+        self.local.set(name, hash_key, entry.value, entry.size, entry.expire_at)
+
+    @staticmethod
+    def _needs_refresh(entry, early_refresh):
+        # 过期值或者提前刷新的值不放进一级缓存
+        return entry.stale or entry.should_refresh(early_refresh)
+
+    def _bypassed(self, model, oid, method):
+        logger.warning(f'缓存不可用, 直接计算:{model} {oid} {method}')
+        self.stats.incr(model, method, 'bypass')
+
+    def cache_with_id(self, table_model=None, id_field='oid', param_fields=None, is_grpc=False, local=True,
+                      serializer=None, ttl=None, stale_ttl=0, early_refresh=0, negative_ttl=None,
+                      is_negative=_is_none):
+        """
+        serializer: app.serializer.Serializer, 不传使用REDIS_CACHE_SERIALIZER等配置的默认值,
+        例如渲染好的大段正文可以用Serializer('json', compress='zlib')
+        ttl: 缓存值的有效秒数, 和值一起存储, 不传永不过期
+        stale_ttl: 过期后还能继续返回旧值的秒数, 期间由一个后台线程刷新(stale-while-revalidate)
+        early_refresh: XFetch的beta, 一般取1.0, 越大越早刷新, 0为不提前刷新
+        negative_ttl: "不存在"的结果单独缓存的秒数, 例如爬虫扫不存在的文章时不再打到数据库,
+        is_negative判断结果是不是"不存在", 默认是返回None
+        """
+        options = CacheOptions(serializer, ttl, stale_ttl, negative_ttl, is_negative)
+
         def decorator(f):
             @wraps(f)
             def wrapper(*args, **kwargs):
                 logger.debug(f'args:{args},kwargs:{kwargs}')
                 method_name = f.__name__
-                if args and isinstance(args[0], Model):
-                    oid = args[0].id
-                    model = args[0].__tablename__
-                else:
-                    model = table_model
-                    oid = kwargs.get(id_field, None)
+                model, oid, params = self._call_key(args, kwargs, table_model, id_field, param_fields)
                 if not oid:
                     return f(*args, **kwargs)
-                if param_fields:
-                    # if no param_fields defined, use all params except id_field
-                    params = get_params(kwargs, id_field, param_fields)
-                else:
-                    params = get_params(kwargs, id_field, kwargs.keys())
-
-                if not self._exists(model, oid, method_name, params):
-
-                    get_lock_number = 0
-                    while get_lock_number < 10:
-                        # if cache exist
-                        cache_lock = self.lock.lock('redis', 15000)
-                        if not cache_lock:
-                            get_lock_number += 1
-                            logger.debug(f'第{get_lock_number}次获取锁失败')
-                            continue
-                        logger.debug("获取锁成功")
-                        response = f(*args, **kwargs)
-                        if is_grpc:
-                            raise BaseError('grpc api')
-                            # compress(response)
-                        # 根据缓存的函数返回值, 写入到缓存中
-                        self._set(model, oid, method_name, params, response)
-                        self.lock.unlock(cache_lock)
-
-                        logger.debug("释放锁成功")
-                        return response
-
-                    raise BaseError("获取锁失败")
-
-                result = self._get(model, oid, method_name, params)
-
-                return result
 
+                computed = []
+
+                def compute():
+                    response = f(*args, **kwargs)
+                    if is_grpc:
+                        raise BaseError('grpc api')
+                        # compress(response)
+                    computed.append(response)
+                    return response
+
+                try:
+                    name = self._get_sorted_name(model, oid)
+                    hash_key = self._get_sorted_hash_key(method_name, params)
+                    use_local = local and self.local is not None
+                    if use_local:
+                        result = self._local_get(name, hash_key)
+                        if result is not _missing:
+                            return result
+
+                    if not self.breaker.allow():
+                        raise CacheUnavailable()
+                    # 反序列化和解压不算进redis的耗时, 熔断器只包住读取
+                    entry = self._decode(self.breaker.call(self._get_raw, name, hash_key))
+                    self.stats.incr(model, method_name, 'hit' if entry.hit else 'miss')
+                    if not entry.hit:
+                        entry = self._single_flight((name, hash_key), self._fill, name, hash_key, compute, options)
+                    elif self._needs_refresh(entry, early_refresh):
+                        if stale_ttl:
+                            self._refresh_in_background(name, hash_key, f, args, kwargs, options)
+                            return entry.value
+                        refreshed = self._refresh(name, hash_key, compute, options)
+                        if refreshed is None:
+                            return entry.value
+                        entry = refreshed
+                except (RedisError, CacheUnavailable):
+                    # redis不可用时不报错, 直接计算
+                    self._bypassed(model, oid, method_name)
+                    return computed[0] if computed else compute()
+
+                if use_local:
+                    self._remember(name, hash_key, entry, options)
+                return entry.value
+
+            # write-through时需要用同样的方式写入
+            wrapper.cache_options = options
             return wrapper
 
         return decorator
 
+    def cache_with_ids(self, table_model, ids_field='oids', param_fields=None, resource_type=None, local=True,
+                       serializer=None, ttl=None, negative_ttl=None):
+        """
+        cache_with_id的批量版本, 被装饰函数接收oid列表, 返回{oid: value}
+
+        命中的oid一个pipeline读出, 只把未命中的oid交给被装饰函数一次算完, 再用一个pipeline写回。
+        resource_type和单个对象的缓存方法名相同时, 两边共用缓存。批量计算不加锁, 过期值按未命中处理。
+        negative_ttl: 被装饰函数没有返回的oid记为"不存在", 缓存negative_ttl秒, 结果里同样不包含这些oid
+        """
+        options = CacheOptions(serializer, ttl, 0, negative_ttl, _is_none)
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                logger.debug(f'args:{args},kwargs:{kwargs}')
+                method_name = resource_type or f.__name__
+                oids = kwargs.get(ids_field)
+                if not oids:
+                    return f(*args, **kwargs)
+                hash_key = self._get_sorted_hash_key(method_name,
+                                                     self._call_params(kwargs, ids_field, param_fields))
+                try:
+                    names = {oid: self._get_sorted_name(table_model, oid) for oid in oids}
+                except (RedisError, CacheUnavailable):
+                    self.stats.incr(table_model, method_name, 'bypass', len(oids))
+                    return f(*args, **kwargs)
+
+                batch = _Batch(self, table_model, method_name, hash_key, names, local, options)
+                pending = batch.from_local(oids)
+                misses = []
+                if pending:
+                    loaded = None
+                    if self.breaker.allow():
+                        try:
+                            raws = self.breaker.call(self._get_raw_many, batch.keys(pending))
+                            loaded = [self._decode(raw) for raw in raws]
+                        except RedisError:
+                            logger.warning(f'批量读取缓存失败:{table_model} {method_name}', exc_info=True)
+                    if loaded is None:
+                        batch.bypassed(pending)
+                        kwargs[ids_field] = pending
+                        batch.results.update(f(*args, **kwargs) or {})
+                        return batch.results
+                    misses = batch.from_redis(pending, loaded)
+
+                if misses:
+                    kwargs[ids_field] = misses
+                    start = time.monotonic()
+                    items = batch.to_store(misses, f(*args, **kwargs) or {}, time.monotonic() - start)
+                    sizes, encoded = self._encode_many(items, options=options)
+                    try:
+                        self.breaker.call(self._hset_many, encoded)
+                    except RedisError:
+                        logger.warning(f'批量写入缓存失败:{table_model} {method_name}', exc_info=True)
+                        sizes = [None] * len(items)
+                    batch.stored(items, sizes)
+
+                return batch.results
+
+            return wrapper
+
+        return decorator
+
+
+class CacheInvalidationProcessor(AbstractBulkEventsProcessor):
+    """
+    按提交的变更删除对象缓存, 一次提交的所有失效在一个pipeline里完成
+
+    Model为None, 处理所有model的变更; models可以限制只处理哪些model
+    update只在active_history=True的字段有变化时失效, model没有这种字段时任何update都失效
+
+    write-through: model的__cache_write_through__列出的缓存方法(cache_with_id装饰的无参数方法),
+    在提交前算好新值, 和失效放在同一个pipeline里写入, 刚编辑过的对象不用再冷启动重算。
+    失效和写入都在提交成功之后执行, 回滚则丢弃。
+
+    redis不可用时失效失败的(model, oid)记在重试队列里, 下一次提交或者熔断器关闭时补上;
+    队列超过retry_max_keys个对象时改为记下model, 重试时整个model升级版本号。
+    """
+    Model = None
+    # 自己在提交后才写缓存, 提交后异步分发时也要在提交前收集变更
+    in_transaction = True
+
+    def __init__(self, redis_cache=None, models=None, session=None, retry_max_keys=10000):
+        self.cache = redis_cache or cache
+        self.models = set(models) if models else None
+        self.retry_max_keys = retry_max_keys
+        self._retry_keys = set()
+        self._retry_models = set()
+        self._retry_lock = threading.Lock()
+        self._retry_breaker = None
+        session = session or db.session
+        event.listen(session, 'after_commit', self._after_commit)
+        event.listen(session, 'after_rollback', self._after_rollback)
+
+    def process(self, sender, changes):
+        # 提交前只记下(model, oid), 缓存名要读redis里的版本号, 留到提交后在熔断器下解析,
+        # redis出问题时不能让写入回滚
+        keys = set()
+        items = []
+        for change in changes:
+            obj, method = change[0], change[1]
+            Model = type(obj)
+            if self.models is not None and Model not in self.models:
+                continue
+            if method == 'update' and len(change) < 3 and has_active_history(Model):
+                continue
+            oid = getattr(obj, 'id', None)
+            if not oid:
+                continue
+            key = (Model.__tablename__, oid)
+            keys.add(key)
+            if method != 'delete':
+                items.extend(key + item for item in self._write_through_items(obj))
+
+        if keys:
+            pending_keys, pending_items = self._pending(db.session)
+            pending_keys.update(keys)
+            pending_items.extend(items)
+
+    def _write_through_items(self, obj):
+        """
+        返回[(hash_key, set_value)]
+        """
+        items = []
+        for method_name in getattr(obj, '__cache_write_through__', ()):
+            method = getattr(type(obj), method_name)
+            start = time.monotonic()
+            try:
+                value = method.__wrapped__(obj)
+            except Exception:
+                # 刷新缓存不能让提交失败, 算不出来的只删除缓存(对象已经在keys里)
+                logger.exception(f'write-through计算失败, 改为删除缓存:{type(obj).__name__} {method_name}')
+                continue
+            options = method.cache_options
+            ttl, stale_ttl = options.ttl_for(value)
+            set_value = self.cache._encode(value, options.serializer, ttl, stale_ttl, time.monotonic() - start)
+            if set_value is not None:
+                items.append((self.cache._get_sorted_hash_key(method.__wrapped__.__name__, None), set_value))
+        return items
+
+    def _pending(self, session):
+        return session.info.setdefault(self, (set(), []))
+
+    def _after_commit(self, session):
+        keys, items = session.info.pop(self, (None, None))
+        if keys:
+            self._invalidate(keys, items)
+
+    def retry(self):
+        """
+        补上之前失败的失效, 熔断器关闭时自动调用
+        """
+        if self._retry_keys or self._retry_models:
+            self._invalidate(set(), [])
+
+    def _invalidate(self, keys, items):
+        # 之前失败的失效并到这一次里
+        with self._retry_lock:
+            keys = keys | self._retry_keys
+            models = self._retry_models
+            self._retry_keys, self._retry_models = set(), set()
+        if not keys and not models:
+            return
+        # 数据已经提交, 失效失败只能记日志, 不能从commit()里抛出去
+        try:
+            # 版本号的读取各自经过熔断器, 熔断器只包住最后一次写入
+            names = {key: self.cache._get_sorted_name(*key) for key in keys if key[0] not in models}
+            if not self.cache.breaker.allow():
+                raise CacheUnavailable()
+            for model in models:
+                self.cache.breaker.call(self.cache.delete, model, None)
+            self.cache.breaker.call(self.cache.write_through, set(names.values()),
+                                    [(names[(model, oid)], hash_key, set_value)
+                                     for model, oid, hash_key, set_value in items if (model, oid) in names])
+        except (RedisError, CacheUnavailable):
+            logger.warning(f'提交后失效缓存失败:{len(keys)}个对象, {len(models)}个model, 稍后重试', exc_info=True)
+            self._add_retry(keys, models)
+
+    def _add_retry(self, keys, models):
+        with self._retry_lock:
+            self._retry_models |= models
+            self._retry_keys |= {key for key in keys if key[0] not in self._retry_models}
+            if len(self._retry_keys) > self.retry_max_keys:
+                # 记不下了, 改为整个model失效
+                self._retry_models |= {model for model, oid in self._retry_keys}
+                self._retry_keys = set()
+            breaker = self.cache.breaker
+            if self._retry_breaker is not breaker:
+                self._retry_breaker = breaker
+                breaker.on_close(self.retry)
+
+    def _after_rollback(self, session):
+        session.info.pop(self, None)
+
 
 cache = RedisCache()
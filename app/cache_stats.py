@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+缓存统计, 按(model, method)记录命中、未命中、计算耗时、锁等待和序列化大小
+
+每个进程先在内存里累加, 每隔flush_interval秒用一个pipeline HINCRBY到redis,
+所有worker和节点的数据汇总在 cache:stats:<model>:<method> 里。
+直方图按2的幂分桶, 只用来估算分位数。
+"""
+import threading
+import time
+from collections import defaultdict
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+HISTOGRAMS = ('fill_ms', 'lock_wait_ms', 'size')
+
+
+def _bucket(value):
+    return int(value).bit_length()
+
+
+class NullCacheStats(object):
+    """
+    统计关闭时使用, 所有记录都不做任何事
+    """
+
+    def incr(self, model, method, field, amount=1):
+        pass
+
+    def observe(self, model, method, histogram, value):
+        pass
+
+    def flush(self):
+        pass
+
+    def report(self):
+        return []
+
+    def reset(self):
+        pass
+
+
+class CacheStats(NullCacheStats):
+    prefix = 'cache:stats:'
+
+    def __init__(self, redis, flush_interval=10):
+        self.redis = redis
+        self.flush_interval = flush_interval
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def incr(self, model, method, field, amount=1):
+        with self._lock:
+            self._counters[(model, method)][field] += amount
+        self._maybe_flush()
+
+    def observe(self, model, method, histogram, value):
+        with self._lock:
+            counters = self._counters[(model, method)]
+            counters[f'{histogram}_count'] += 1
+            counters[f'{histogram}_sum'] += int(value)
+            counters[f'{histogram}:{_bucket(value)}'] += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(lambda: defaultdict(int))
+            self._flushed_at = time.monotonic()
+        if not counters:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for (model, method), fields in counters.items():
+                key = f'{self.prefix}{model}:{method}'
+                for field, amount in fields.items():
+                    pipe.hincrby(key, field, amount)
+            pipe.execute()
+        except Exception:
+            # 统计丢了不影响业务
+            logger.exception('缓存统计写入redis失败')
+
+    def report(self):
+        """
+        汇总所有进程的统计, 返回[{model, method, hit, miss, hit_rate, ...}], 按请求数倒序
+        """
+        self.flush()
+        rows = []
+        for key in self.redis.scan_iter(match=f'{self.prefix}*', count=1000):
+            key = key.decode('utf8')
+            model, method = key[len(self.prefix):].split(':', 1)
+            fields = {k.decode('utf8'): int(v) for k, v in self.redis.hgetall(key).items()}
+            rows.append(self._summary(model, method, fields))
+        return sorted(rows, key=lambda row: row['hit'] + row['local_hit'] + row['miss'], reverse=True)
+
+    @staticmethod
+    def _summary(model, method, fields):
+        hit, local_hit, miss = fields.get('hit', 0), fields.get('local_hit', 0), fields.get('miss', 0)
+        total = hit + local_hit + miss
+        row = {
+            'model': model,
+            'method': method,
+            'hit': hit,
+            'local_hit': local_hit,
+            'miss': miss,
+            'hit_rate': round((hit + local_hit) / total, 4) if total else None,
+            'lock_attempts': fields.get('lock_attempts', 0),
+            'lock_failures': fields.get('lock_failures', 0),
+        }
+        for histogram in HISTOGRAMS:
+            count = fields.get(f'{histogram}_count', 0)
+            row[f'{histogram}_avg'] = round(fields.get(f'{histogram}_sum', 0) / count, 2) if count else None
+            buckets = sorted((int(k.rsplit(':', 1)[1]), v) for k, v in fields.items()
+                             if k.startswith(f'{histogram}:'))
+            for percentile in (50, 95, 99):
+                row[f'{histogram}_p{percentile}'] = _percentile(buckets, count, percentile)
+        return row
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+        keys = list(self.redis.scan_iter(match=f'{self.prefix}*', count=1000))
+        if keys:
+            self.redis.delete(*keys)
+
+
+def _percentile(buckets, count, percentile):
+    """
+    按分桶估算分位数, 返回桶的上界
+    """
+    if not count:
+        return None
+    threshold = count * percentile / 100
+    seen = 0
+    for bucket, n in buckets:
+        seen += n
+        if seen >= threshold:
+            return (1 << bucket) - 1 if bucket else 0
+    return (1 << buckets[-1][0]) - 1 if buckets else None
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+熔断器
+
+连续failure_threshold次出错或者慢于slow_threshold秒就打开, 打开期间allow()返回False,
+调用方直接走降级逻辑。reset_timeout秒后进入半开状态, 只放一个探测请求,
+探测成功就关闭, 失败继续打开。
+"""
+import threading
+import time
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    def __init__(self, name, failure_threshold=5, slow_threshold=0.05, reset_timeout=5, errors=(Exception,)):
+        self.name = name
+        self.errors = errors
+        self.failure_threshold = failure_threshold
+        self.slow_threshold = slow_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._close_listeners = []
+
+    def on_close(self, fn):
+        """
+        注册熔断器从打开(半开)恢复到关闭时调用的函数, 例如重试熔断期间失败的写入
+        """
+        self._close_listeners.append(fn)
+        return fn
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+                logger.info(f'熔断器{self.name}半开, 开始探测')
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return self.state == CLOSED
+
+    def record_success(self, elapsed=0):
+        if self.slow_threshold and elapsed > self.slow_threshold:
+            logger.debug(f'熔断器{self.name}慢调用:{elapsed:.3f}s')
+            self.record_failure()
+            return
+        if self.state == CLOSED and not self._failures:
+            return
+        with self._lock:
+            recovered = self.state != CLOSED
+            if recovered:
+                logger.info(f'熔断器{self.name}关闭')
+            self.state = CLOSED
+            self._failures = 0
+            self._probing = False
+        if recovered:
+            for fn in self._close_listeners:
+                try:
+                    fn()
+                except Exception:
+                    logger.exception(f'熔断器{self.name}关闭后的回调出错')
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                logger.warning(f'熔断器{self.name}打开, 连续失败{self._failures}次')
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def call(self, fn, *args, **kwargs):
+        """
+        执行fn并记录耗时, 出错记为失败后原样抛出
+        """
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except self.errors:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.record_other_error()
+            raise
+        self.record_success(time.monotonic() - start)
+        return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """
+        call的协程版本, fn返回awaitable
+        """
+        start = time.monotonic()
+        try:
+            result = await fn(*args, **kwargs)
+        except self.errors:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.record_other_error()
+            raise
+        self.record_success(time.monotonic() - start)
+        return result
+
+    def record_other_error(self):
+        """
+        errors以外的异常(例如反序列化出错)不计入连续失败, 但半开时的探测要记为失败,
+        否则_probing一直为True, allow()再也不放行
+        """
+        if self.state == HALF_OPEN:
+            self.record_failure()
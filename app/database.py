@@ -1,25 +1,37 @@
 # -*- coding:utf-8 -*-
+import asyncio
+import atexit
 import hashlib
 import itertools
 import json
 import os
+import queue
+import threading
+import time
 import uuid
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import sqlalchemy.sql.schema
 import sqlalchemy.sql.sqltypes
 import sqlalchemy.orm.properties
 from logging import getLogger
 
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy, _SessionSignalEvents, SignallingSession, before_models_committed
+from sqlalchemy import and_, or_
 from sqlalchemy import event
 from sqlalchemy import inspect
 from sqlalchemy import types
 from sqlalchemy import text
 
 from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm import ColumnProperty
 from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.session import Session as SessionBase
-from sqlalchemy.ext.declarative.base import declared_attr
+from sqlalchemy.ext.declarative import declared_attr
 
 log = getLogger(__name__)
 
@@ -102,7 +114,41 @@ class Password(types.TypeDecorator):
         return sha256sum(value) if value else None
 
 
+_active_history_models = {}
+
+
+def has_active_history(Model):
+    """
+    model是否有active_history=True的字段
+    """
+    result = _active_history_models.get(Model)
+    if result is None:
+        result = _active_history_models[Model] = any(prop.active_history
+                                                      for prop in inspect(Model).column_attrs)
+    return result
+
+
+def get_values_log(obj):
+    """
+    active_history=True的字段在本次flush中的变化, {key: (old, new)}
+    """
+    state = inspect(obj)
+    values_log = {}
+    for prop in state.mapper.column_attrs:
+        if not prop.active_history:
+            continue
+        history = state.attrs[prop.key].history
+        if history.has_changes():
+            values_log[prop.key] = (history.deleted[0] if history.deleted else None,
+                                    history.added[0] if history.added else None)
+    return values_log
+
+
 class AbstractProcessor:
+    # SQLALCHEMY_EVENTS_DISPATCH为after_commit时, in_transaction=True的处理函数仍然在提交前同步执行
+    # 适合自己在提交后才产生副作用的处理函数, 例如app.cache.CacheInvalidationProcessor
+    in_transaction = False
+
     def process(self, sender, changes):
         raise NotImplementedError
 
@@ -152,34 +198,108 @@ class AbstractSingleEventsProcessor(AbstractProcessor):
         raise NotImplementedError
 
 
+def _merge_values_log(old, new):
+    merged = dict(old or {})
+    for key, (old_value, new_value) in (new or {}).items():
+        merged[key] = (merged.get(key, (old_value, new_value))[0], new_value)
+    # 改了又改回去的字段没有净变化
+    return {key: value for key, value in merged.items() if value[0] != value[1]}
+
+
+def coalesce_changes(changes):
+    """
+    同一个对象的多次变更合并成一次净变更, 按第一次出现的顺序返回
+    insert+update -> insert, insert+delete -> 没有变更, update+update -> update(values_log合并),
+    update+delete -> delete, delete+insert -> insert
+    """
+    net = {}
+    for change in changes:
+        key = id(change[0])
+        current = net.get(key)
+        if current is None:
+            net[key] = change
+            continue
+        obj, method = change[0], change[1]
+        if method == 'delete':
+            net[key] = (obj, None) if current[1] == 'insert' else (obj, 'delete')
+        elif method == 'insert' or current[1] is None:
+            net[key] = (obj, 'insert')
+        elif current[1] == 'update':
+            values_log = _merge_values_log(current[2] if len(current) > 2 else None,
+                                           change[2] if len(change) > 2 else None)
+            net[key] = (obj, 'update', values_log) if values_log else (obj, 'update')
+    if len(net) == len(changes):
+        return changes
+    return [change for change in net.values() if change[1] is not None]
+
+
 class EventsProcessorProxy(object):
+    """
+    processor按Model的MRO查找, 父类(包括多态继承的基类)的processor也处理子类的变更, 查找结果按类缓存
+    一次提交里同一个对象的多次变更先合并成净变更
+    """
+
     def __init__(self):
         self.bulk_processors_map = {}
         self.single_processors_map = {}
+        self._bulk_lookup = {}
+        self._single_lookup = {}
+
+    def process(self, sender, changes, in_transaction=None):
+        """
+        in_transaction为None时执行全部处理函数, 否则只执行processor.in_transaction相同的
+        """
+        changes = coalesce_changes(changes)
+        if not self.bulk_processors_map and not self.single_processors_map:
+            return
+        # 一次遍历按Model分桶, 每个Model只查找一次processor
+        buckets = self._bucket(changes)
 
-    def process(self, sender, changes):
         if self.bulk_processors_map:
-            self.process_bulk_processor(sender, changes)
+            self.process_bulk_processor(sender, changes, in_transaction, buckets)
 
         if self.single_processors_map:
-            self.process_single_processor(sender, changes)
+            self.process_single_processor(sender, changes, in_transaction, buckets)
 
-    def process_bulk_processor(self, sender, changes):
-        for Model, changes in itertools.groupby(sorted(changes, key=lambda change: type(change[0]).__name__),
-                                                lambda change: type(change[0])):
-            changes = list(changes)
-            processor = self.bulk_processors_map.get(Model)
-            self._process(sender, processor, changes)
+    @staticmethod
+    def _resolve(processors_map, lookup, Model):
+        try:
+            return lookup[Model]
+        except KeyError:
+            processor = next((processors_map[cls] for cls in Model.__mro__ if cls in processors_map), None)
+            lookup[Model] = processor
+            return processor
+
+    def process_bulk_processor(self, sender, changes, in_transaction=None, buckets=None):
+        # Model为None的bulk processor处理一次提交的全部变更
+        self._process(sender, self.bulk_processors_map.get(None), changes, in_transaction)
+        # 父类的processor一次处理所有子类的变更
+        grouped = {}
+        for Model, bucket in (buckets or self._bucket(changes)).items():
+            processor = self._resolve(self.bulk_processors_map, self._bulk_lookup, Model)
+            if processor is not None:
+                grouped.setdefault(processor, []).extend(bucket)
+        for processor, bucket in grouped.items():
+            self._process(sender, processor, bucket, in_transaction)
+
+    def process_single_processor(self, sender, changes, in_transaction=None, buckets=None):
+        for Model, bucket in (buckets or self._bucket(changes)).items():
+            processor = self._resolve(self.single_processors_map, self._single_lookup, Model)
+            if processor is None or (in_transaction is not None and processor.in_transaction != in_transaction):
+                continue
+            for change in bucket:
+                processor.process(sender, change)
 
-    def process_single_processor(self, sender, changes):
-        if self.single_processors_map:
-            for change in changes:
-                processor = self.single_processors_map.get(type(change[0]))
-                self._process(sender, processor, change)
+    @staticmethod
+    def _bucket(changes):
+        buckets = {}
+        for change in changes:
+            buckets.setdefault(type(change[0]), []).append(change)
+        return buckets
 
     @classmethod
-    def _process(cls, sender, processor, changes):
-        if processor:
+    def _process(cls, sender, processor, changes, in_transaction=None):
+        if processor and (in_transaction is None or processor.in_transaction == in_transaction):
             processor.process(sender, changes)
 
     def add_processors(self, *processors):
@@ -192,10 +312,147 @@ class EventsProcessorProxy(object):
 
             else:
                 raise Exception('Processor can not add')
+        self._bulk_lookup = {}
+        self._single_lookup = {}
 
     def clear(self):
         self.single_processors_map = {}
         self.bulk_processors_map = {}
+        self._bulk_lookup = {}
+        self._single_lookup = {}
+
+
+class ChangeRecord(namedtuple('ChangeRecord', 'model pk method values_log snapshot')):
+    """
+    提交后处理用的变更记录, 不引用session里的对象
+
+    pk是主键的tuple; snapshot只有delete才有, 是删除前已加载的字段值
+    """
+
+    @classmethod
+    def from_change(cls, change):
+        obj, method = change[0], change[1]
+        values_log = change[2] if len(change) > 2 else None
+        state = inspect(obj)
+        snapshot = None
+        if method == 'delete':
+            snapshot = {prop.key: state.dict[prop.key] for prop in state.mapper.column_attrs if prop.key in state.dict}
+        return cls(type(obj), state.identity, method, values_log, snapshot)
+
+
+def load_changes(records):
+    """
+    在当前session里把ChangeRecord还原成(obj, method[, values_log])
+    insert/update按model批量重新查询, 已经被后来的事务删掉的跳过; delete用snapshot构造游离的对象
+    """
+    objs = {}
+    pending = [record for record in records if record.method != 'delete']
+    for Model, group in itertools.groupby(sorted(pending, key=lambda record: record.model.__name__),
+                                          lambda record: record.model):
+        pks = {record.pk for record in group}
+        pk_columns = inspect(Model).primary_key
+        if len(pk_columns) == 1:
+            for obj in Model.query.filter(pk_columns[0].in_([pk[0] for pk in pks])):
+                objs[(Model, inspect(obj).identity)] = obj
+        else:
+            for pk in pks:
+                obj = Model.query.get(pk)
+                if obj is not None:
+                    objs[(Model, pk)] = obj
+
+    changes = []
+    for record in records:
+        if record.method == 'delete':
+            # 同一个对象的多条变更要用同一个实例, 才能被合并
+            obj = objs.get((record.model, record.pk))
+            if obj is None:
+                obj = objs[(record.model, record.pk)] = inspect(record.model).class_manager.new_instance()
+                for key, value in (record.snapshot or {}).items():
+                    set_committed_value(obj, key, value)
+        else:
+            obj = objs.get((record.model, record.pk))
+            if obj is None:
+                log.debug(f'变更的对象已经不存在:{record.model.__name__} {record.pk}')
+                continue
+        changes.append((obj, record.method, record.values_log) if record.values_log else (obj, record.method))
+    return changes
+
+
+class AfterCommitDispatcher(object):
+    """
+    提交之后在后台线程里执行处理函数, 写接口不用等处理函数
+
+    有界队列: 队列满时最多等put_timeout秒, 还是满的就在当前请求里处理(背压, 不丢事件)
+    失败按retry_delay指数退避重试retries次, 每次重试会重新执行全部处理函数, 处理函数要能重复执行
+    进程退出时最多等drain_timeout秒把队列处理完; 进程崩溃时队列里的变更会丢失
+    """
+
+    def __init__(self, app, events_processor, workers=4, queue_size=1000, retries=3, retry_delay=0.5,
+                 put_timeout=1, drain_timeout=10):
+        self.app = app
+        self.events_processor = events_processor
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.put_timeout = put_timeout
+        self.drain_timeout = drain_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.drain)
+
+    def _ensure_workers(self):
+        # 按进程启动, fork出来的worker重新启动自己的线程
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f'events-dispatch-{i}', daemon=True).start()
+
+    def submit(self, sender, records):
+        if not records:
+            return
+        self._ensure_workers()
+        try:
+            self.queue.put((sender, records), timeout=self.put_timeout)
+        except queue.Full:
+            log.warning(f'事件队列已满, 在当前请求里处理{len(records)}个变更')
+            # 这里还在提交的after_commit里, 当前线程的db.session正在提交, 不能拿来查询;
+            # db.session按线程划分, 另起一个线程用它自己的session处理, 当前请求等它结束
+            thread = threading.Thread(target=self._run, args=(sender, records), name='events-dispatch-inline')
+            thread.start()
+            thread.join()
+
+    def _work(self):
+        while True:
+            sender, records = self.queue.get()
+            try:
+                self._run(sender, records)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, sender, records):
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self.app.app_context():
+                    self.events_processor.process(sender, load_changes(records), in_transaction=False)
+                    # 处理函数自己的写入
+                    db.session.commit()
+                return
+            except Exception:
+                log.exception(f'处理提交后的变更失败, 第{attempt}次')
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+        log.error(f'放弃处理{len(records)}个变更: {[(r.model.__name__, r.pk, r.method) for r in records]}')
+
+    def drain(self):
+        deadline = time.monotonic() + self.drain_timeout
+        while self._pid == os.getpid() and self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
 
 
 class UUID(types.TypeDecorator):
@@ -270,6 +527,9 @@ class DataBase(SQLAlchemy):
     def __init__(self, *args, **kwargs):
         self.session = None  # type:SessionBase
         self.events_processor = None  # type: EventsProcessorProxy
+        self._async_executor = None
+        self.dispatcher = None  # type: AfterCommitDispatcher
+        self.outbox_writer = None
         super(DataBase, self).__init__(*args, **kwargs)
 
     def init_app(self, app):
@@ -277,6 +537,7 @@ class DataBase(SQLAlchemy):
         log.info('Base Init DB')
         self.app = app
         super(DataBase, self).init_app(app)
+        app.teardown_appcontext(RequestLoader.teardown)
         self.configure_log_sql_echo()
         self.configure_signal_events()
 
@@ -295,28 +556,220 @@ class DataBase(SQLAlchemy):
 
     def configure_signal_events(self):
         self.events_processor = EventsProcessorProxy()
+        config = self.app.config
+        # sync: 提交前在请求里执行处理函数; after_commit: 提交后交给后台线程;
+        # outbox: 和业务数据一起写入events_outbox, 由events_drain命令处理, 见app.outbox
+        mode = config.get('SQLALCHEMY_EVENTS_DISPATCH', 'sync')
+        if mode == 'outbox':
+            from app.outbox import write_changes
+            self.outbox_writer = write_changes
+        elif mode == 'after_commit':
+            self.dispatcher = AfterCommitDispatcher(self.app, self.events_processor,
+                                                    workers=config.get('SQLALCHEMY_EVENTS_WORKERS', 4),
+                                                    queue_size=config.get('SQLALCHEMY_EVENTS_QUEUE_SIZE', 1000),
+                                                    retries=config.get('SQLALCHEMY_EVENTS_RETRIES', 3),
+                                                    retry_delay=config.get('SQLALCHEMY_EVENTS_RETRY_DELAY', 0.5),
+                                                    put_timeout=config.get('SQLALCHEMY_EVENTS_PUT_TIMEOUT', 1))
+
+        # flush之后history就清空了, 在每次flush之前记录active_history字段的变化
+        @event.listens_for(self.session, 'before_flush')
+        def _record_values_log(session, flush_context, instances):
+            values_logs = session.info.setdefault('values_log', {})
+            for obj in session.dirty:
+                if not has_active_history(type(obj)):
+                    continue
+                values_log = get_values_log(obj)
+                if not values_log:
+                    continue
+                key = inspect(obj).identity_key
+                if key in values_logs:
+                    # 一个事务里多次flush, 保留最早的旧值
+                    for k, (old, new) in values_log.items():
+                        values_logs[key][k] = (values_logs[key].get(k, (old, new))[0], new)
+                else:
+                    values_logs[key] = values_log
+
+        @event.listens_for(self.session, 'after_commit')
+        @event.listens_for(self.session, 'after_rollback')
+        def _clear_values_log(session):
+            session.info.pop('values_log', None)
+
+        @event.listens_for(self.session, 'after_commit')
+        def _dispatch_after_commit(session):
+            records = session.info.pop('deferred_changes', None)
+            if records:
+                self.dispatcher.submit(self.app, records)
+
+        @event.listens_for(self.session, 'after_rollback')
+        def _discard_deferred_changes(session):
+            session.info.pop('deferred_changes', None)
 
         @before_models_committed.connect_via(self.app)
         def _before_models_committed(sender, changes):
             db.session.flush()
-            self.events_processor.process(sender, changes)
+            values_logs = db.session.info.get('values_log', {})
+            if values_logs:
+                changes = [self._attach_values_log(change, values_logs) for change in changes]
+            # outbox这类内部表的变更不产生事件
+            changes = [change for change in changes if not getattr(change[0], '__events_ignore__', False)]
+            if self.dispatcher is None and self.outbox_writer is None:
+                self.events_processor.process(sender, changes)
+                return
+            self.events_processor.process(sender, changes, in_transaction=True)
+            if self.outbox_writer is not None:
+                self.outbox_writer(db.session, changes)
+                return
+            db.session.info.setdefault('deferred_changes', []).extend(ChangeRecord.from_change(change)
+                                                                      for change in changes)
+
+    def _executor(self):
+        if self._async_executor is None:
+            workers = self.app.config.get('SQLALCHEMY_ASYNC_WORKERS', 8)
+            self._async_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db-async')
+        return self._async_executor
+
+    def _run_in_app_context(self, fn, *args, **kwargs):
+        # 每个线程有自己的db.session, app context结束时flask_sqlalchemy会remove掉
+        with self.app.app_context():
+            return fn(*args, **kwargs)
+
+    async def run_async(self, fn, *args, **kwargs):
+        """
+        async视图里执行同步的查询, fn在线程池里用独立的session执行, 只有app context没有request context
+        fn里的修改需要自己commit; 返回的对象已经和session分离, 访问未加载的关系会报错
+        线程数SQLALCHEMY_ASYNC_WORKERS, 默认8, 不要超过连接池的大小
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor(), partial(self._run_in_app_context, fn, *args, **kwargs))
+
+    async def gather(self, *calls):
+        """
+        并发执行多个互不依赖的查询, calls是函数或者(函数, 参数...)
+        例如: article, comments = await db.gather((Article.query.get, oid), partial(get_comments, oid))
+        """
+        return await asyncio.gather(*(self.run_async(*call) if isinstance(call, tuple) else self.run_async(call)
+                                      for call in calls))
+
+    @staticmethod
+    def _attach_values_log(change, values_logs):
+        obj, method = change[0], change[1]
+        if method == 'update':
+            values_log = values_logs.get(inspect(obj).identity_key)
+            if values_log:
+                return obj, method, values_log
+        return change
 
     @staticmethod
     def get_or_create(model, defaults=None, **kwargs):
         """
-        获取或者创建对象，模仿django的。
+        获取或者创建对象，模仿django的。不提交事务
+
+        kwargs要对应一个唯一索引。先查询, 不存在时用upsert写入(mysql: INSERT IGNORE, sqlite: INSERT OR IGNORE,
+        其他数据库用savepoint), 并发创建不会重复, 也不会抛唯一键冲突。只有这次真正写入的对象is_new=True
+        """
+        return db.get_or_create_many(model, [kwargs], defaults)[0]
+
+    @staticmethod
+    def get_or_create_many(model, keys, defaults=None):
+        """
+        批量get_or_create, keys是[{字段: 值}], 每个dict的字段相同
+        一次查询已有的, 不存在的一条多行upsert写入后再查询一次; 按keys的顺序返回对象
+        defaults可以是dict, 也可以是根据key返回dict的函数
+        """
+        if not keys:
+            return []
+        fields = sorted(keys[0])
+
+        def key_of(values):
+            return tuple(values[field] for field in fields)
+
+        def select(wanted):
+            if len(fields) == 1:
+                column = getattr(model, fields[0])
+                condition = column.in_([key[fields[0]] for key in wanted])
+            else:
+                condition = or_(*(and_(*(getattr(model, field) == key[field] for field in fields))
+                                  for key in wanted))
+            rows = model.query.filter(condition).all()
+            by_value = {key_of({field: getattr(obj, field) for field in fields}): obj for obj in rows}
+            matched = {key_of(key): by_value[key_of(key)] for key in wanted if key_of(key) in by_value}
+            if len({id(obj) for obj in matched.values()}) < len(rows):
+                # 有行没对上: 数据库的比较规则和python不同(例如不区分大小写的collation, 字符串'1'比较整数字段),
+                # 没对上的key按数据库的规则逐个查询
+                for key in wanted:
+                    if key_of(key) not in matched:
+                        obj = model.query.filter_by(**key).first()
+                        if obj is not None:
+                            matched[key_of(key)] = obj
+            return matched
+
+        found = select(keys)
+        for obj in found.values():
+            setattr(obj, 'is_new', False)
+        missing = list({key_of(key): key for key in keys if key_of(key) not in found}.values())
+        if missing:
+            rows = [dict(key, **(defaults(key) if callable(defaults) else defaults or {})) for key in missing]
+            inserted = db._insert_missing(model, rows)
+            created = select(missing)
+            for index, key in enumerate(missing):
+                obj = created.get(key_of(key))
+                if obj is None:
+                    continue
+                # 并发时别的事务写入的行按已有的处理, 不重复产生insert事件
+                setattr(obj, 'is_new', index in inserted)
+                if index in inserted:
+                    db._record_insert(obj)
+                found[key_of(key)] = obj
+        return [found.get(key_of(key)) for key in keys]
+
+    @staticmethod
+    def _insert_missing(model, rows):
         """
-        instance = model.query.filter_by(**kwargs).first()
-        defaults = bool(defaults) and defaults or {}
-        if instance:
-            setattr(instance, 'is_new', False)
+        写入rows, 已经存在的跳过, 返回这次真正写入的行的下标
+        """
+        session = db.session()
+        table = model.__table__
+        dialect = session.get_bind(mapper=inspect(model)).dialect.name
+        if dialect == 'mysql':
+            # ON DUPLICATE KEY UPDATE在CLIENT_FOUND_ROWS(mysql驱动默认打开)下重复的行也计入rowcount, IGNORE不计
+            statement = mysql.insert(table).prefix_with('IGNORE')
+        elif dialect == 'sqlite':
+            statement = table.insert().prefix_with('OR IGNORE')
         else:
-            kwargs.update(defaults)
-            instance = model(**kwargs)
-            db.session.add(instance)
-            db.session.commit()
-            setattr(instance, 'is_new', True)
-        return instance
+            statement = None
+
+        if statement is not None:
+            # 一般一条语句全部写入; 有行被跳过时分不清是哪几行, 回滚后逐行写入, 按每行的rowcount判断
+            savepoint = session.begin_nested()
+            try:
+                rowcount = session.execute(statement, rows).rowcount
+            except BaseException:
+                savepoint.rollback()
+                raise
+            if rowcount == len(rows):
+                savepoint.commit()
+                return set(range(len(rows)))
+            savepoint.rollback()
+            return {index for index, values in enumerate(rows) if session.execute(statement, values).rowcount}
+
+        inserted = set()
+        for index, values in enumerate(rows):
+            try:
+                with session.begin_nested():
+                    session.add(model(**values))
+                inserted.add(index)
+            except IntegrityError:
+                log.debug(f'{model.__name__}已经被创建:{values}')
+        return inserted
+
+    @staticmethod
+    def _record_insert(obj):
+        """
+        core写入的行不经过ORM, 手动记为insert, 提交时一样产生变更事件
+        """
+        changes = getattr(db.session(), '_model_changes', None)
+        if changes is not None:
+            changes[inspect(obj).identity_key] = (obj, 'insert')
 
     def Column(self, *args, **kwargs):
         # 给pycharm自动提示用的
@@ -354,8 +807,136 @@ class DataBase(SQLAlchemy):
 db = DataBase()
 
 
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+_pk_types = {}
+_consecutive_autoinc = {}
+
+
+def _mysql_consecutive_autoinc(session, bind):
+    """
+    mysql一条多行INSERT的自增id是否一定连续, 每个engine只查一次
+    innodb_autoinc_lock_mode为0或1时行数确定的INSERT一次分配连续的id;
+    2(8.0的默认值)时并发的INSERT交错分配, 不能按LAST_INSERT_ID()推算
+    """
+    engine = bind.engine
+    result = _consecutive_autoinc.get(engine)
+    if result is None:
+        try:
+            mode = session.execute(text('SELECT @@innodb_autoinc_lock_mode')).scalar()
+        except DBAPIError:
+            mode = None
+        result = _consecutive_autoinc[engine] = mode is not None and int(mode) in (0, 1)
+        if not result:
+            log.info(f'innodb_autoinc_lock_mode={mode}, 批量创建走ORM的flush')
+    return result
+
+
+def _pk_type(Model):
+    python_type = _pk_types.get(Model, False)
+    if python_type is False:
+        column = inspect(Model).primary_key[0]
+        python_type = None
+        # TypeDecorator的python_type是底层类型, 和查询结果的类型不一定相同(例如UUID), 不转换
+        if not isinstance(column.type, types.TypeDecorator):
+            try:
+                python_type = column.type.python_type
+            except NotImplementedError:
+                pass
+        _pk_types[Model] = python_type
+    return python_type
+
+
+def normalize_oid(Model, oid):
+    """
+    oid转换成主键的类型, 例如整数主键传'1'和1是同一个对象; 转换不了的原样返回
+    """
+    python_type = _pk_type(Model)
+    if python_type is None or isinstance(oid, python_type):
+        return oid
+    try:
+        return python_type(oid)
+    except (TypeError, ValueError):
+        return oid
+
+
+class RequestLoader(object):
+    """
+    请求内的对象加载器, 保存在flask.g里, app context结束时清空
+
+    同一个请求里重复加载的对象直接从内存返回, 不存在的oid也会记下来。
+    defer先登记之后要用的oid, 下一次加载这个model时和要加载的oid一起用一次IN查询取出。
+    oid按主键的类型转换后再比较
+    """
+
+    def __init__(self):
+        self._objs = {}
+        self._pending = defaultdict(set)
+
+    @staticmethod
+    def current():
+        if not has_app_context():
+            return None
+        loader = g.get('_request_loader')
+        if loader is None:
+            loader = g._request_loader = RequestLoader()
+        return loader
+
+    @staticmethod
+    def teardown(exception=None):
+        g.pop('_request_loader', None)
+
+    def defer(self, Model, oids):
+        oids = (normalize_oid(Model, oid) for oid in oids)
+        self._pending[Model].update(oid for oid in oids if (Model, oid) not in self._objs)
+
+    def get(self, Model, oid):
+        oid = normalize_oid(Model, oid)
+        if (Model, oid) not in self._objs:
+            self._pending[Model].add(oid)
+            self._resolve(Model)
+        return self._lookup(Model, oid)
+
+    def get_many(self, Model, oids):
+        self.defer(Model, oids)
+        self._resolve(Model)
+        objs = {oid: self._lookup(Model, normalize_oid(Model, oid)) for oid in oids}
+        return {oid: obj for oid, obj in objs.items() if obj is not None}
+
+    def discard(self, Model, oid):
+        self._objs.pop((Model, normalize_oid(Model, oid)), None)
+
+    def _lookup(self, Model, oid):
+        obj = self._objs[(Model, oid)]
+        if obj is None:
+            # 记为不存在之后, 同一个请求里可能又创建了; 和query.get一样先flush, 再看session里有没有
+            session = db.session()
+            if session.autoflush and any(isinstance(new, Model) for new in session.new):
+                session.flush()
+            obj = session.identity_map.get(inspect(Model).identity_key_from_primary_key((oid,)))
+            if obj is not None:
+                self._objs[(Model, oid)] = obj
+        return obj
+
+    def _resolve(self, Model):
+        oids = self._pending.pop(Model, None)
+        if not oids:
+            return
+        for chunk in _chunks(oids, Model._chunk_size()):
+            for obj in Model._query_many(chunk):
+                self._objs[(Model, inspect(obj).identity[0])] = obj
+        for oid in oids:
+            self._objs.setdefault((Model, oid), None)
+
+
 class AbstractModel(db.Model):
     __abstract__ = True
+    # 提交后直接写入缓存的方法名, 见app.cache.CacheInvalidationProcessor
+    __cache_write_through__ = ()
 
     @classmethod
     def _validate_values(cls, values):
@@ -370,19 +951,174 @@ class AbstractModel(db.Model):
 
     @classmethod
     def delete(cls, oid):
-        db.session.delete(cls.query.get(oid))
+        db.session.delete(cls.load(oid))
+        loader = RequestLoader.current()
+        if loader is not None:
+            loader.discard(cls, oid)
         return True
 
     @classmethod
     def update(cls, oid, values):
         cls._validate_values(values)
-        obj = cls.query.get(oid)
+        obj = cls.load(oid)
         obj.update_values(**values)
 
+    @classmethod
+    def load(cls, oid):
+        """
+        请求内加载对象, 重复加载不再查询, 不存在返回None; 没有app context时等同于query.get
+        """
+        loader = RequestLoader.current()
+        if loader is None:
+            return cls.query.get(oid)
+        return loader.get(cls, oid)
+
+    @classmethod
+    def load_many(cls, oids):
+        """
+        请求内批量加载, 只查询还没加载过的oid, 返回{oid: obj}, 不包含不存在的oid
+        """
+        loader = RequestLoader.current()
+        if loader is None:
+            objs = {inspect(obj).identity[0]: obj for obj in cls._query_many(oids)}
+            return {oid: objs[normalize_oid(cls, oid)] for oid in oids if normalize_oid(cls, oid) in objs}
+        return loader.get_many(cls, oids)
+
+    @classmethod
+    def defer(cls, *oids):
+        """
+        登记之后要加载的oid, 和下一次load/load_many一起查询
+        """
+        loader = RequestLoader.current()
+        if loader is not None:
+            loader.defer(cls, oids)
+
     def update_values(self, **kwargs):
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+    # 批量操作按块执行, 块大小默认取SQLALCHEMY_BULK_CHUNK_SIZE, 提交时和单个操作一样产生变更事件
+    # update_many/delete_many每块一次flush, flush会把同样字段的UPDATE/DELETE合并成executemany
+    # create_many见_insert_many
+
+    @staticmethod
+    def _chunk_size(chunk_size=None):
+        return chunk_size or db.app.config.get('SQLALCHEMY_BULK_CHUNK_SIZE', 500)
+
+    @classmethod
+    def _query_many(cls, oids):
+        pk = inspect(cls).primary_key
+        if len(pk) != 1:
+            raise Exception('%s has composite primary key' % cls.__name__)
+        return cls.query.filter(pk[0].in_(oids))
+
+    @classmethod
+    def create_many(cls, values_list, chunk_size=None):
+        """
+        按values_list的顺序返回创建的对象
+        """
+        instances = []
+        for chunk in _chunks(values_list, cls._chunk_size(chunk_size)):
+            objs = []
+            for values in chunk:
+                cls._validate_values(values)
+                objs.append(cls(**values))
+            created = cls._insert_many(objs)
+            if created is None:
+                db.session.add_all(objs)
+                db.session.flush()
+                created = objs
+            instances.extend(created)
+        return instances
+
+    @classmethod
+    def _core_rows(cls, objs):
+        """
+        对象上设置过的字段转成列的值, 只有单表、自增主键、没有给定主键、只设置了普通字段并且每行字段相同时才返回
+        """
+        mapper = inspect(cls)
+        table = cls.__table__
+        if len(mapper.tables) != 1 or table._autoincrement_column is None:
+            return None
+        pk_key = table._autoincrement_column.key
+        rows = []
+        for obj in objs:
+            state = inspect(obj)
+            if any(relationship.key in state.dict for relationship in mapper.relationships):
+                return None
+            row = {prop.columns[0].key: state.dict[prop.key] for prop in mapper.column_attrs if prop.key in state.dict}
+            if row.get(pk_key) is not None or (rows and row.keys() != rows[0].keys()):
+                return None
+            rows.append(row)
+        return rows
+
+    @classmethod
+    def _insert_many(cls, objs):
+        """
+        每块一条多行INSERT, 再按生成的id一次查询取回, 取回的对象手动记为insert; 不能这样写入时返回None, 走ORM的flush
+        一条INSERT生成的自增id是连续的: mysql从LAST_INSERT_ID()开始按auto_increment_increment递增
+        (只在innodb_autoinc_lock_mode为0或1时成立, 否则返回None), sqlite到最后一个rowid为止;
+        其他数据库用RETURNING
+        """
+        rows = cls._core_rows(objs)
+        if not rows:
+            return None
+        session = db.session()
+        mapper = inspect(cls)
+        bind = session.get_bind(mapper=mapper)
+        dialect = bind.dialect
+        statement = cls.__table__.insert().values(rows)
+        if dialect.name == 'mysql':
+            if not _mysql_consecutive_autoinc(session, bind):
+                return None
+            step = session.execute(text('SELECT @@auto_increment_increment')).scalar()
+            first = session.execute(statement).lastrowid
+            ids = [first + i * step for i in range(len(rows))]
+        elif dialect.name == 'sqlite':
+            last = session.execute(statement).lastrowid
+            ids = list(range(last - len(rows) + 1, last + 1))
+        elif dialect.implicit_returning:
+            ids = [row[0] for row in session.execute(statement.returning(cls.__table__._autoincrement_column))]
+        else:
+            return None
+        created = {inspect(obj).identity[0]: obj for obj in cls._query_many(ids)}
+        if len(created) != len(ids):
+            raise Exception('%s: 按生成的id只取回了%s/%s行' % (cls.__name__, len(created), len(ids)))
+        for obj in created.values():
+            db._record_insert(obj)
+        return [created[oid] for oid in ids]
+
+    @classmethod
+    def update_many(cls, oids, values, chunk_size=None):
+        """
+        每块一次SELECT ... IN加一次flush, 返回更新的数量, 不存在的oid忽略
+        """
+        cls._validate_values(values)
+        count = 0
+        for chunk in _chunks(oids, cls._chunk_size(chunk_size)):
+            for obj in cls._query_many(chunk):
+                obj.update_values(**values)
+                count += 1
+            db.session.flush()
+        return count
+
+    @classmethod
+    def delete_many(cls, oids, chunk_size=None):
+        """
+        每块一次SELECT ... IN加一次flush, 返回删除的数量, 不存在的oid忽略
+        """
+        count = 0
+        for chunk in _chunks(oids, cls._chunk_size(chunk_size)):
+            for obj in cls._query_many(chunk):
+                db.session.delete(obj)
+                count += 1
+            loader = RequestLoader.current()
+            if loader is not None:
+                for oid in chunk:
+                    loader.discard(cls, oid)
+            db.session.flush()
+        return count
+
 
 class BaseModel(AbstractModel):
     __abstract__ = True
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+一致性哈希环
+
+每个节点在环上放replicas个虚拟节点, 虚拟节点的位置只由节点id决定,
+和节点的顺序无关。增加一个节点时只有大约1/n的key会换到新节点上,
+其余的key留在原来的节点。
+"""
+import hashlib
+from bisect import bisect
+from collections import defaultdict
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    def __init__(self, nodes, replicas=160):
+        """
+        nodes: {node_id: client}, node_id要稳定, 一般用host:port/db
+        """
+        if not nodes:
+            raise Exception('hash ring needs at least one node')
+        self.nodes = dict(nodes)
+        self.replicas = replicas
+        ring = sorted((_hash('%s#%s' % (node_id, i)), node_id) for node_id in self.nodes for i in range(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._node_ids = [node_id for _, node_id in ring]
+        self._single = next(iter(self.nodes)) if len(self.nodes) == 1 else None
+
+    def get_node_id(self, key):
+        if self._single is not None:
+            return self._single
+        index = bisect(self._hashes, _hash(key))
+        return self._node_ids[index % len(self._node_ids)]
+
+    def get(self, key):
+        return self.nodes[self.get_node_id(key)]
+
+    def group(self, keys):
+        """
+        按节点分组, 返回{node_id: [下标]}, 用于每个节点发一个pipeline
+        """
+        groups = defaultdict(list)
+        for index, key in enumerate(keys):
+            groups[self.get_node_id(key)].append(index)
+        return groups
+
+    def __len__(self):
+        return len(self.nodes)
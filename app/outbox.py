@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+事件outbox
+
+SQLALCHEMY_EVENTS_DISPATCH为outbox时, 提交的变更和业务数据在同一个事务里写入events_outbox,
+提交成功就不会丢; 由`flask events_drain`按批读出, 交给EventsProcessorProxy处理, 处理完在同一个事务里推进检查点。
+处理函数可能对同一批变更执行多次(至少一次), 要能重复执行。
+
+自增id的顺序和提交顺序不完全一致: 检查点推进时跳过的id记为空洞(gaps), 之后每一批都连同空洞一起查询,
+晚提交的事务写入的变更不会被跳过。事务回滚也会留下空洞, 超过gap_timeout秒还没出现的id视为已回滚, 不再等待;
+事务执行时间不能超过gap_timeout。
+"""
+import time
+from logging import getLogger
+
+from sqlalchemy import or_
+from sqlalchemy.dialects import mysql
+
+from app.database import ChangeRecord, db, load_changes
+from app.serializer import Serializer, loads
+
+log = getLogger(__name__)
+
+_serializer = Serializer('pickle')
+
+
+class OutboxEvent(db.Model):
+    __tablename__ = 'events_outbox'
+    __events_ignore__ = True
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    model = db.Column(db.String(64), nullable=False)
+    method = db.Column(db.String(8), nullable=False)
+    # (主键, values_log, delete的快照)
+    payload = db.Column(db.LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'), nullable=False)
+    create_time = db.Column(db.TIMESTAMP, server_default=db.text('CURRENT_TIMESTAMP'), nullable=False, index=True)
+
+
+class OutboxCheckpoint(db.Model):
+    __tablename__ = 'events_outbox_checkpoint'
+    __events_ignore__ = True
+
+    name = db.Column(db.String(64), primary_key=True)
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)
+    # 还没出现的id区间 [[起始id, 结束id, 发现的时间]], 整体赋值才会保存
+    gaps = db.Column(db.JSONEncodedDict)
+
+
+_models = {}
+
+
+def _model_by_table(tablename):
+    Model = _models.get(tablename)
+    if Model is None:
+        for cls in db.Model._decl_class_registry.values():
+            if getattr(cls, '__tablename__', None):
+                _models[cls.__tablename__] = cls
+        Model = _models.get(tablename)
+    return Model
+
+
+def write_changes(session, changes):
+    """
+    在当前事务里写入变更, 用core的insert, 不产生新的model变更
+    """
+    rows = []
+    for change in changes:
+        record = ChangeRecord.from_change(change)
+        rows.append({
+            'model': record.model.__tablename__,
+            'method': record.method,
+            'payload': _serializer.dumps((record.pk, record.values_log, record.snapshot)),
+        })
+    if rows:
+        session.execute(OutboxEvent.__table__.insert(), rows)
+
+
+def _to_record(row):
+    Model = _model_by_table(row.model)
+    if Model is None:
+        log.warning(f'outbox里的表没有对应的model:{row.model} id={row.id}')
+        return None
+    pk, values_log, snapshot = loads(row.payload)
+    return ChangeRecord(Model, tuple(pk), row.method, values_log, snapshot)
+
+
+def _split(start, end, found):
+    """
+    [start, end]去掉found里的id, 返回剩下的区间
+    """
+    for oid in sorted(oid for oid in found if start <= oid <= end):
+        if oid > start:
+            yield start, oid - 1
+        start = oid + 1
+    if start <= end:
+        yield start, end
+
+
+def _update_gaps(gaps, last_id, ids):
+    """
+    去掉这一批里出现的id, 再加上last_id之后新跳过的id
+    """
+    now = time.time()
+    found = set(ids)
+    result = [[start, end, seen_at] for gap_start, gap_end, seen_at in gaps
+              for start, end in _split(gap_start, gap_end, found)]
+    expected = last_id + 1
+    for oid in sorted(oid for oid in found if oid > last_id):
+        if oid > expected:
+            result.append([expected, oid - 1, now])
+        expected = oid + 1
+    return result
+
+
+def _expire_gaps(name, gaps, gap_timeout):
+    deadline = time.time() - gap_timeout
+    expired = [gap for gap in gaps if gap[2] < deadline]
+    if expired:
+        log.info(f'outbox {name} 不再等待的id(事务已回滚): {[gap[:2] for gap in expired]}')
+    return [gap for gap in gaps if gap[2] >= deadline]
+
+
+def _prune():
+    """
+    删除所有检查点都已经处理过的行: 每个检查点取last_id和最小的空洞之前, 再取所有检查点里最小的
+    id最大的一行总是保留, mysql 8.0之前重启后按max(id)+1恢复自增值, 删空了id会从检查点之前重新开始
+    """
+    positions = [min([gap[0] - 1 for gap in checkpoint.gaps or ()] + [checkpoint.last_id])
+                 for checkpoint in OutboxCheckpoint.query.all()]
+    max_id = db.session.query(db.func.max(OutboxEvent.id)).scalar()
+    if positions and max_id is not None:
+        (OutboxEvent.query
+         .filter(OutboxEvent.id <= min(positions), OutboxEvent.id < max_id)
+         .delete(synchronize_session=False))
+
+
+def drain(events_processor, sender, name='default', batch_size=1000, gap_timeout=300, prune=False):
+    """
+    处理检查点之后的全部变更和之前空洞里新出现的变更, 返回处理的行数
+    同名的drainer通过锁检查点的行互斥, 不同名字各自独立处理一遍
+    """
+    processed = 0
+    while True:
+        checkpoint = OutboxCheckpoint.query.with_for_update().get(name)
+        if checkpoint is None:
+            # 新的检查点从现有的第一行开始, 已经被删掉的id不算空洞
+            first_id = db.session.query(db.func.min(OutboxEvent.id)).scalar()
+            checkpoint = OutboxCheckpoint(name=name, last_id=(first_id or 1) - 1, gaps=[])
+            db.session.add(checkpoint)
+            db.session.flush()
+        gaps = _expire_gaps(name, checkpoint.gaps or [], gap_timeout)
+        rows = (OutboxEvent.query
+                .filter(or_(OutboxEvent.id > checkpoint.last_id,
+                            *(OutboxEvent.id.between(start, end) for start, end, _ in gaps)))
+                .order_by(OutboxEvent.id)
+                .limit(batch_size)
+                .all())
+        if rows:
+            records = [record for record in map(_to_record, rows) if record is not None]
+            events_processor.process(sender, load_changes(records), in_transaction=False)
+            gaps = _update_gaps(gaps, checkpoint.last_id, [row.id for row in rows])
+            checkpoint.last_id = max(checkpoint.last_id, rows[-1].id)
+        if gaps != (checkpoint.gaps or []):
+            checkpoint.gaps = gaps
+        if prune:
+            _prune()
+        # 处理函数的写入和检查点一起提交
+        db.session.commit()
+        if not rows:
+            break
+        processed += len(rows)
+        log.info(f'outbox {name} 处理到 {checkpoint.last_id}, 本批{len(rows)}行, 空洞{len(gaps)}个')
+    return processed
+
+
+def follow(events_processor, sender, interval=1, **kwargs):
+    """
+    持续处理, 没有新变更时等待interval秒
+    """
+    while True:
+        try:
+            if not drain(events_processor, sender, **kwargs):
+                time.sleep(interval)
+        except Exception:
+            log.exception('outbox处理失败, 稍后重试')
+            db.session.rollback()
+            time.sleep(interval)
@@ -1,12 +1,18 @@
 # author = matt.cai(cysnake4713@gmail.com)
 import pickle
+import threading
+import zlib
+from collections import OrderedDict
 from enum import Enum
+from logging import getLogger
 
 from flask import session
-from flask_principal import Principal, Identity, AnonymousIdentity
+from flask_principal import Principal, Identity, AnonymousIdentity, ItemNeed, Need, Permission
 
 # from zeroso.base.principal.needs import login_need
 
+logger = getLogger(__name__)
+
 
 class AuthType(Enum):
     FROM_SESSION = 1
@@ -14,46 +20,401 @@ class AuthType(Enum):
     TEST_CASE = 3
 
 
+class PermissionRegistry(object):
+    """
+    Need和整数id的对应关系, session里只存id列表
+
+    id按注册顺序分配, 所有进程要以相同的顺序注册(在模块导入时注册即可)。
+    version由Need的数量和注册的全部Need算出; 新的Need只追加在末尾时旧session里的id仍然可用,
+    调整了顺序或者删除了Need后旧的id不再可信。
+
+    另外每个Need在进程内有一个bit位, identity.provides和Permission都编译成整数,
+    权限判断只需要一次位运算。bit位只在进程内使用, 和session里的id无关。
+    Permission用到的Need才分配bit位; 按对象动态创建的Permission会一直占用bit位, 数量要有限。
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._needs = []
+        self._version = None
+        self._compatible = {}
+        self._bits = {}
+        # 每分配一个新的bit位加一, identity的bitset据此判断是否要重新编译
+        self.epoch = 0
+        self._lock = threading.Lock()
+
+    def register(self, *needs):
+        with self._lock:
+            for need in needs:
+                if need not in self._ids:
+                    self._ids[need] = len(self._needs)
+                    self._needs.append(need)
+                    self._version = None
+                    self._compatible = {}
+                self._intern(need)
+        return [self._ids[need] for need in needs]
+
+    def _intern(self, need):
+        bit = self._bits.get(need)
+        if bit is None:
+            bit = self._bits[need] = 1 << len(self._bits)
+            self.epoch += 1
+        return bit
+
+    def mask(self, needs):
+        """
+        Permission的needs编译成bitset, 没有bit位的Need分配一个
+        """
+        with self._lock:
+            mask = 0
+            for need in needs:
+                mask |= self._intern(need)
+            return mask
+
+    def bits(self, needs):
+        """
+        identity.provides编译成bitset, 没有bit位的Need不会被任何Permission用到, 直接忽略
+        """
+        bits = 0
+        for need in needs:
+            bits |= self._bits.get(need, 0)
+        return bits
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = self._prefix_version(len(self._needs))
+        return self._version
+
+    def _prefix_version(self, count):
+        return '%d-%08x' % (count, zlib.crc32(repr(self._needs[:count]).encode('utf8')))
+
+    def compatible(self, version):
+        """
+        session里记录的注册表版本对应的id现在是否还能用
+        """
+        result = self._compatible.get(version)
+        if result is None:
+            count, sep, _ = version.partition('-')
+            if not sep:
+                # 只有crc的旧版本号, 注册表完全没变才能用
+                result = version == '%08x' % zlib.crc32(repr(self._needs).encode('utf8'))
+            else:
+                result = count.isdigit() and int(count) <= len(self._needs) and \
+                    self._prefix_version(int(count)) == version
+            self._compatible[version] = result
+        return result
+
+    def encode(self, needs):
+        """
+        返回(已注册Need的id列表, 未注册的Need)
+        """
+        ids = []
+        extra = []
+        for need in needs:
+            need_id = self._ids.get(need)
+            if need_id is None:
+                extra.append(list(need))
+            else:
+                ids.append(need_id)
+        ids.sort()
+        extra.sort(key=repr)
+        return ids, extra
+
+    def decode(self, ids, extra=()):
+        needs = {self._needs[need_id] for need_id in ids}
+        needs.update(ItemNeed(*need) if len(need) == 3 else Need(*need) for need in extra)
+        return frozenset(needs)
+
+    def version_of(self, ids, extra=()):
+        """
+        一组权限的版本号, 注册表或者权限变化时都会改变
+        """
+        return '%s.%08x' % (self.version, zlib.crc32(repr((ids, extra)).encode('utf8')))
+
+
+class _IdentityCache(object):
+    """
+    进程内的LRU, (identity id, 权限版本号) -> 解码后的provides
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+registry = PermissionRegistry()
+
+
+class NeedSet(set):
+    """
+    identity.provides用的set, 缓存编译好的bitset, 修改时清掉
+    """
+
+    def __init__(self, *args):
+        super(NeedSet, self).__init__(*args)
+        self._compiled = None
+
+    @property
+    def bits(self):
+        compiled = self._compiled
+        if compiled is None or compiled[0] != registry.epoch:
+            compiled = self._compiled = (registry.epoch, registry.bits(self))
+        return compiled[1]
+
+    def _mutator(name):
+        method = getattr(set, name)
+
+        def wrapper(self, *args):
+            self._compiled = None
+            return method(self, *args)
+
+        wrapper.__name__ = name
+        return wrapper
+
+    for _name in ('add', 'update', 'discard', 'remove', 'pop', 'clear', 'difference_update',
+                  'intersection_update', 'symmetric_difference_update', '__ior__', '__iand__', '__isub__',
+                  '__ixor__'):
+        locals()[_name] = _mutator(_name)
+    del _mutator, _name
+
+
+class BitPermission(Permission):
+    """
+    needs和excludes第一次判断时编译成bitset, identity.provides是NeedSet时用位运算判断
+    编译后不要再修改needs和excludes
+    """
+
+    _masks = None
+
+    def _compile(self):
+        if self._masks is None:
+            self._masks = (registry.mask(self.needs), registry.mask(self.excludes))
+        return self._masks
+
+    def allows(self, identity):
+        provides = identity.provides
+        if not isinstance(provides, NeedSet):
+            return super(BitPermission, self).allows(identity)
+        needs, excludes = self._compile()
+        bits = provides.bits
+        if needs and not bits & needs:
+            return False
+        if excludes and bits & excludes:
+            return False
+        return True
+
+    @classmethod
+    def _from(cls, permission):
+        result = cls(*permission.needs)
+        result.excludes.update(permission.excludes)
+        return result
+
+    def union(self, other):
+        return self._from(super(BitPermission, self).union(other))
+
+    def difference(self, other):
+        return self._from(super(BitPermission, self).difference(other))
+
+    def reverse(self):
+        return self._from(super(BitPermission, self).reverse())
+
+
+_identity_cache = _IdentityCache()
+_user_loader = None
+_permissions_loader = None
+
+
+def user_loader(fn):
+    """
+    注册根据用户id加载用户的函数, identity.user第一次被访问时调用
+    """
+    global _user_loader
+    _user_loader = fn
+    return fn
+
+
+def permissions_loader(fn):
+    """
+    注册根据用户计算权限(返回Need列表)的函数, session里的权限id因为注册表变化不能再用时调用
+    """
+    global _permissions_loader
+    _permissions_loader = fn
+    return fn
+
+
+class SessionIdentity(Identity):
+    """
+    从session恢复的identity, provides和user在第一次访问时才解码
+    """
+
+    def __init__(self, id, auth_type=None, data=None):
+        super(SessionIdentity, self).__init__(id, auth_type)
+        self._data = data or {}
+        self._provides = None
+        self._user = None
+        self._user_loaded = False
+        # session里的权限已经不能解码, 也没有重新计算, 保存时不能覆盖
+        self.stale = False
+
+    @property
+    def decoded(self):
+        return self._provides is not None
+
+    @property
+    def provides(self):
+        if self._provides is None:
+            self._provides = self._decode_provides()
+        return self._provides
+
+    @provides.setter
+    def provides(self, value):
+        self._provides = value
+
+    @property
+    def user(self):
+        if not self._user_loaded:
+            self._user = self._load_user()
+            self._user_loaded = True
+        return self._user
+
+    @user.setter
+    def user(self, value):
+        self._user = value
+        self._user_loaded = True
+
+    @property
+    def uid(self):
+        """
+        要保存的用户id, 只有user已经加载(或者是旧session里pickle的)时才从user取, 不为此查询用户
+        """
+        if self._user_loaded or self._data.get('legacy_user'):
+            uid = getattr(self.user, 'id', None)
+            if uid is not None:
+                return uid
+        return self._data.get('uid')
+
+    def _decode_provides(self):
+        data = self._data
+        if data.get('legacy_provides'):
+            # 升级前写入的session
+            return NeedSet(pickle.loads(data['legacy_provides']))
+        version = data.get('version')
+        if not version:
+            return NeedSet()
+        if not registry.compatible(version.split('.', 1)[0]):
+            return self._reload_provides()
+        key = (self.id, version)
+        needs = _identity_cache.get(key)
+        if needs is None:
+            needs = registry.decode(data.get('perms') or (), data.get('extra') or ())
+            _identity_cache.set(key, needs)
+        # identity_loaded的其他处理函数可能会往provides里加Need, 不能改缓存里的
+        return NeedSet(needs)
+
+    def _reload_provides(self):
+        """
+        注册表变化后按用户重新计算权限; 没有注册permissions_loader时这次请求没有权限,
+        session里的权限原样保留, 不会被写成空的
+        """
+        user = self.user if _permissions_loader is not None else None
+        if user is not None:
+            logger.info(f'权限注册表已变化, 重新计算权限:{self.id}')
+            return NeedSet(_permissions_loader(user))
+        logger.warning(f'权限注册表已变化, 忽略session里的权限:{self.id}')
+        self.stale = True
+        return NeedSet()
+
+    def _load_user(self):
+        data = self._data
+        if data.get('legacy_user'):
+            return pickle.loads(data['legacy_user'])
+        if data.get('uid') is not None and _user_loader is not None:
+            return _user_loader(data['uid'])
+
+
 principal_config = Principal(use_sessions=False)
+# 权限注册表, Need在模块导入时通过principal_config.registry.register注册
+principal_config.registry = registry
+
+_session_keys = ('identity.perms', 'identity.extra', 'identity.version', 'identity.uid')
 
 
 @principal_config.identity_loader
 def session_identity_loader():
     if 'identity.id' in session and 'identity.auth_type' in session:
-        identity = Identity(session['identity.id'], auth_type=AuthType.FROM_SESSION)
+        data = {
+            'perms': session.get('identity.perms'),
+            'extra': session.get('identity.extra'),
+            'version': session.get('identity.version'),
+            'uid': session.get('identity.uid'),
+            'legacy_provides': session.get('identity.provides'),
+            'legacy_user': session.get('identity.user'),
+        }
+        identity = SessionIdentity(session['identity.id'], auth_type=AuthType.FROM_SESSION, data=data)
         return identity
 
 
+def _update_session(values):
+    """
+    只写入有变化的key, 值为None的key删除; 没有变化时session.modified保持不变
+    """
+    for key, value in values.items():
+        if value is None:
+            if key in session:
+                session.pop(key)
+        elif session.get(key) != value:
+            session[key] = value
+
+
 @principal_config.identity_saver
 def session_identity_saver(identity):
     if isinstance(identity, AnonymousIdentity):
-        session.pop('identity.id')
-        session.pop('identity.auth_type')
-        session.pop('identity.provides')
-        session.pop('identity.user')
-        session.modified = True
+        _update_session(dict.fromkeys(('identity.id', 'identity.auth_type', 'identity.provides', 'identity.user')
+                                      + _session_keys))
+    elif isinstance(identity, SessionIdentity) and (not identity.decoded or identity.stale):
+        # 没有访问过provides, 和session里的一样, 不用重新编码; 解码不了的权限也原样保留
+        _update_session({'identity.id': identity.id, 'identity.auth_type': 'session_load'})
     else:
-        # pickle write to redis may slow down the system, must use cpickle to do this
-        session['identity.id'] = identity.id
-        session['identity.auth_type'] = 'session_load'
-        # WARNING: use pickle to save object maybe cause problem
-        pickle_string = pickle.dumps(identity.provides)
-        session['identity.provides'] = pickle_string
-        user_string = pickle.dumps(identity.user)
-        session['identity.user'] = user_string
-        session.modified = True
+        # 只存权限id和用户id, 不再pickle整个对象
+        perms, extra = registry.encode(identity.provides)
+        _update_session({
+            'identity.id': identity.id,
+            'identity.auth_type': 'session_load',
+            'identity.perms': perms,
+            'identity.extra': extra or None,
+            'identity.version': registry.version_of(perms, extra),
+            'identity.uid': identity.uid if isinstance(identity, SessionIdentity) else
+            getattr(getattr(identity, 'user', None), 'id', None),
+            'identity.provides': None,
+            'identity.user': None,
+        })
 
 
 def on_identity_loaded(sender, identity):
+    if not isinstance(identity, SessionIdentity) and not isinstance(identity.provides, NeedSet):
+        # BitPermission只对NeedSet用位运算
+        identity.provides = NeedSet(identity.provides)
     if isinstance(identity, AnonymousIdentity):
         pass
     elif identity.auth_type == AuthType.FROM_SESSION:
-        provides = session.get('identity.provides', None)
-        if provides:
-            identity.provides = pickle.loads(provides)
-        user = session.get('identity.user')
-        if user:
-            identity.user = pickle.loads(user)
+        # provides和user由SessionIdentity在第一次访问时解码
+        pass
     elif identity.auth_type == AuthType.LOGIN:
         pass
         # identity.provides.update(login_need.needs)
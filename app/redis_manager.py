@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+redis连接管理, 缓存、session和锁共用按db划分的连接池
+
+配置都在conf['redis']里:
+    REDIS_HOST / REDIS_PORT / REDIS_PASSWORD
+    REDIS_UNIX_SOCKET: 设置后走unix socket, 忽略host和port
+    REDIS_MAX_CONNECTIONS: 每个db的连接池上限, 默认64
+    REDIS_POOL_TIMEOUT: 连接池用完时等待的秒数, 默认5, 超时抛ConnectionError
+    REDIS_SOCKET_TIMEOUT / REDIS_SOCKET_CONNECT_TIMEOUT: 秒
+    REDIS_SOCKET_KEEPALIVE: 默认True
+    REDIS_HEALTH_CHECK_INTERVAL: 空闲连接多久后先PING再用, 默认30秒
+    REDIS_PARSER: hiredis | python, 默认装了hiredis就用hiredis
+
+get_async返回redis.asyncio的客户端(redis>=4.2), 参数相同, 连接池按事件循环分开
+"""
+import asyncio
+import os
+import threading
+import weakref
+from logging import getLogger
+
+import redis
+from redis import BlockingConnectionPool, StrictRedis
+from redis.connection import Connection, UnixDomainSocketConnection
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = getLogger(__name__)
+
+
+def _gevent_queue_class():
+    """
+    gevent打了补丁时用gevent的队列, 等连接的时候让出协程而不是阻塞线程
+    """
+    try:
+        from gevent import monkey
+        from gevent.queue import LifoQueue
+    except ImportError:
+        return None
+    return LifoQueue if monkey.is_module_patched('socket') else None
+
+
+def _parser_class(name):
+    parsers = getattr(redis, '_parsers', None) or redis.connection
+    if name == 'python':
+        return getattr(parsers, 'PythonParser', None) or getattr(parsers, '_RESP2Parser')
+    if name == 'hiredis' or name is None:
+        hiredis = getattr(parsers, 'HiredisParser', None) or getattr(parsers, '_HiredisParser', None)
+        if hiredis is not None and getattr(parsers, 'HIREDIS_AVAILABLE', False):
+            return hiredis
+        if name == 'hiredis':
+            logger.warning('hiredis不可用, 使用默认的python parser')
+    return None
+
+
+class RedisManager(object):
+    _instance = None
+    _fork_hooked = False
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pools = {}
+        self._async_pools = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(RedisManager, cls).__new__(cls)
+        return cls._instance
+
+    def init_app(self, app):
+        self.app = app
+        self.disconnect()
+        if hasattr(os, 'register_at_fork') and not self._fork_hooked:
+            # fork出来的worker不能复用父进程的socket
+            os.register_at_fork(after_in_child=self._after_fork)
+            RedisManager._fork_hooked = True
+
+    def _pool_kwargs(self, db, overrides):
+        config = self.app.config
+        kwargs = {
+            'db': int(db),
+            'password': config.get('REDIS_PASSWORD'),
+            'max_connections': int(config.get('REDIS_MAX_CONNECTIONS', 64)),
+            'timeout': config.get('REDIS_POOL_TIMEOUT', 5),
+            'socket_timeout': config.get('REDIS_SOCKET_TIMEOUT'),
+            'socket_connect_timeout': config.get('REDIS_SOCKET_CONNECT_TIMEOUT'),
+            'health_check_interval': config.get('REDIS_HEALTH_CHECK_INTERVAL', 30),
+        }
+        if config.get('REDIS_UNIX_SOCKET') and 'host' not in overrides:
+            kwargs['connection_class'] = UnixDomainSocketConnection
+            kwargs['path'] = config['REDIS_UNIX_SOCKET']
+        else:
+            kwargs['connection_class'] = Connection
+            kwargs['host'] = config['REDIS_HOST']
+            kwargs['port'] = int(config.get('REDIS_PORT', 6379))
+            kwargs['socket_keepalive'] = config.get('REDIS_SOCKET_KEEPALIVE', True)
+        parser_class = _parser_class(config.get('REDIS_PARSER'))
+        if parser_class is not None:
+            kwargs['parser_class'] = parser_class
+        queue_class = _gevent_queue_class()
+        if queue_class is not None:
+            kwargs['queue_class'] = queue_class
+        kwargs.update(overrides)
+        return kwargs
+
+    def _async_pool_kwargs(self, db, overrides):
+        kwargs = self._pool_kwargs(db, overrides)
+        # 协程版本有自己的连接类和队列, 同步的parser和gevent队列都不能用
+        kwargs.pop('parser_class', None)
+        kwargs.pop('queue_class', None)
+        if kwargs['connection_class'] is UnixDomainSocketConnection:
+            kwargs['connection_class'] = aioredis.UnixDomainSocketConnection
+        else:
+            kwargs['connection_class'] = aioredis.Connection
+        return kwargs
+
+    def pool(self, db=0, **overrides):
+        """
+        overrides覆盖连接参数(例如更短的socket_timeout), 参数不同的使用单独的连接池
+        """
+        key = (int(db), tuple(sorted(overrides.items())))
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = BlockingConnectionPool(**self._pool_kwargs(db, overrides))
+                    logger.info(f'Redis Pool Created db={db} {overrides}')
+        return pool
+
+    def get(self, db=0, **overrides):
+        """
+        返回共用db连接池的客户端, 客户端本身很轻, 可以随时创建
+        """
+        return StrictRedis(connection_pool=self.pool(db, **overrides))
+
+    def get_async(self, db=0, **overrides):
+        """
+        协程客户端, 只能在事件循环里调用
+        连接不能跨事件循环使用, 连接池按事件循环分开, 循环被回收时连接池一起回收。
+        flask的async视图每个请求一个事件循环, 连接只在请求内复用; ASGI服务器只有一个循环, 和同步版本一样复用
+        """
+        if aioredis is None:
+            raise Exception('redis.asyncio is not available, redis>=4.2 is required')
+        loop = asyncio.get_running_loop()
+        key = (int(db), tuple(sorted(overrides.items())))
+        with self._lock:
+            pools = self._async_pools.get(loop)
+            if pools is None:
+                pools = self._async_pools[loop] = {}
+            pool = pools.get(key)
+            if pool is None:
+                pool = pools[key] = aioredis.BlockingConnectionPool(**self._async_pool_kwargs(db, overrides))
+        return aioredis.StrictRedis(connection_pool=pool)
+
+    def disconnect(self):
+        """
+        关闭并丢弃所有连接池
+        """
+        self._async_pools = weakref.WeakKeyDictionary()
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            try:
+                pool.disconnect()
+            except Exception:
+                logger.exception('关闭redis连接池失败')
+
+    def _after_fork(self):
+        # 保留连接池对象, 已经拿到客户端的地方不受影响; 只清掉继承来的连接, 不碰父进程的socket
+        self._lock = threading.Lock()
+        self._async_pools = weakref.WeakKeyDictionary()
+        for pool in self._pools.values():
+            pool.reset()
+
+
+redis_manager = RedisManager()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+flask-session的redis后端, 减少每个请求对redis的写
+
+flask-session每个请求都会把整个session重新SET一遍, 这里:
+    读取时GET和TTL放在一个pipeline里, 记下序列化内容的摘要和剩余时间
+    保存时内容的摘要没变就不SET, 只在距离上次续期超过SESSION_TTL_REFRESH_INTERVAL秒时EXPIRE续期
+    序列化用app.serializer.Serializer, 大的session按SESSION_COMPRESS压缩
+"""
+import hashlib
+from logging import getLogger
+
+from flask_session.sessions import RedisSessionInterface
+from itsdangerous import BadSignature, want_bytes
+
+logger = getLogger(__name__)
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class CompactRedisSessionInterface(RedisSessionInterface):
+    def __init__(self, redis, key_prefix, use_signer=False, permanent=True, serializer=None, refresh_interval=60):
+        super(CompactRedisSessionInterface, self).__init__(redis, key_prefix, use_signer, permanent)
+        if serializer is not None:
+            self.serializer = serializer
+        self.refresh_interval = refresh_interval
+
+    def _new_session(self):
+        session = self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+        session.content_hash = None
+        return session
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if not sid:
+            return self._new_session()
+        if self.use_signer:
+            try:
+                sid = self._get_signer(app).unsign(sid).decode('utf8')
+            except BadSignature:
+                return self._new_session()
+        if not isinstance(sid, str):
+            sid = sid.decode('utf8', 'strict')
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.key_prefix + sid)
+        pipe.ttl(self.key_prefix + sid)
+        val, ttl = pipe.execute()
+        if val is None:
+            session = self.session_class(sid=sid, permanent=self.permanent)
+            session.content_hash = None
+            return session
+        try:
+            session = self.session_class(self.serializer.loads(val), sid=sid)
+        except Exception:
+            logger.warning(f'session解码失败:{sid}', exc_info=True)
+            session = self.session_class(sid=sid, permanent=self.permanent)
+            session.content_hash = None
+            return session
+        session.content_hash = _digest(val)
+        session.ttl = ttl
+        return session
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        name = self.key_prefix + session.sid
+        if not session:
+            if session.modified:
+                self.redis.delete(name)
+                response.delete_cookie(app.config['SESSION_COOKIE_NAME'], domain=domain, path=path)
+            return
+
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        val = self.serializer.dumps(dict(session))
+        content_hash = _digest(val)
+        if content_hash != getattr(session, 'content_hash', None):
+            self.redis.setex(name=name, value=val, time=lifetime)
+        elif getattr(session, 'ttl', -1) < lifetime - self.refresh_interval:
+            # 内容没变, 只续期
+            self.redis.expire(name, lifetime)
+        else:
+            return
+
+        if self.use_signer:
+            session_id = self._get_signer(app).sign(want_bytes(session.sid))
+        else:
+            session_id = session.sid
+        response.set_cookie(app.config['SESSION_COOKIE_NAME'], session_id,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
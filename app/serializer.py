@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+缓存和session共用的序列化
+
+每段数据前面加一个字节的头: 低4位是序列化格式, 高4位是压缩方式。
+头的取值都小于0x80, 而旧数据是默认协议的pickle, 第一个字节一定是0x80,
+所以新旧格式、不同格式和压缩方式的数据可以混在一起读。
+"""
+import json
+import pickle
+import zlib
+from logging import getLogger
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+logger = getLogger(__name__)
+
+FORMAT_PICKLE = 1
+FORMAT_JSON = 2
+FORMAT_MSGPACK = 3
+
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_LZ4 = 2
+
+_LEGACY_PICKLE = 0x80
+
+_formats = {
+    'pickle': FORMAT_PICKLE,
+    'json': FORMAT_JSON,
+    'msgpack': FORMAT_MSGPACK,
+}
+
+_compressions = {
+    None: COMPRESS_NONE,
+    'zlib': COMPRESS_ZLIB,
+    'lz4': COMPRESS_LZ4,
+}
+
+
+def _encode(fmt, value):
+    if fmt == FORMAT_PICKLE:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    elif fmt == FORMAT_JSON:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+    else:
+        return msgpack.packb(value, use_bin_type=True)
+
+
+def _decode(fmt, data):
+    if fmt == FORMAT_PICKLE:
+        return pickle.loads(data)
+    elif fmt == FORMAT_JSON:
+        return json.loads(data.decode('utf8'))
+    elif fmt == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise Exception('msgpack is not installed')
+        return msgpack.unpackb(data, raw=False)
+    raise Exception('unknown serializer format %s' % fmt)
+
+
+def _compress(codec, data, level):
+    if codec == COMPRESS_ZLIB:
+        return zlib.compress(data, level)
+    return lz4.compress(data)
+
+
+def _decompress(codec, data):
+    if codec == COMPRESS_NONE:
+        return data
+    elif codec == COMPRESS_ZLIB:
+        return zlib.decompress(data)
+    elif codec == COMPRESS_LZ4:
+        if lz4 is None:
+            raise Exception('lz4 is not installed')
+        return lz4.decompress(data)
+    raise Exception('unknown compress codec %s' % codec)
+
+
+def loads(data):
+    """
+    按头部字节解码, 不需要知道写入时用的是哪个Serializer
+    """
+    if data[0] == _LEGACY_PICKLE:
+        return pickle.loads(data)
+    header = data[0]
+    body = _decompress(header >> 4, memoryview(data)[1:])
+    return _decode(header & 0x0f, bytes(body))
+
+
+class Serializer(object):
+    """
+    format: pickle | json | msgpack
+    compress: None | zlib | lz4, 超过compress_threshold字节并且压缩后更小才压缩
+    """
+
+    def __init__(self, format='pickle', compress=None, compress_threshold=1024, compress_level=6):
+        if format not in _formats:
+            raise Exception('serializer format %s not supported' % format)
+        if compress not in _compressions:
+            raise Exception('compress %s not supported' % compress)
+        if format == 'msgpack' and msgpack is None:
+            raise Exception('msgpack is not installed')
+        if compress == 'lz4' and lz4 is None:
+            raise Exception('lz4 is not installed')
+        self.format = _formats[format]
+        self.compress = _compressions[compress]
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    @classmethod
+    def from_config(cls, config, prefix):
+        return cls(format=config.get(f'{prefix}_SERIALIZER', 'pickle'),
+                   compress=config.get(f'{prefix}_COMPRESS', None),
+                   compress_threshold=config.get(f'{prefix}_COMPRESS_THRESHOLD', 1024))
+
+    def dumps(self, value):
+        data = _encode(self.format, value)
+        codec = COMPRESS_NONE
+        if self.compress and len(data) > self.compress_threshold:
+            compressed = _compress(self.compress, data, self.compress_level)
+            if len(compressed) < len(data):
+                codec, data = self.compress, compressed
+        return bytes(((codec << 4) | self.format,)) + data
+
+    @staticmethod
+    def loads(data):
+        return loads(data)
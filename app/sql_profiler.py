@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# coding:utf8
+"""
+按请求统计SQL
+
+每条语句都计时, 超过SQL_PROFILER_SLOW_MS毫秒的查询连同参数打warning, 不受抽样影响。
+按SQL_PROFILER_SAMPLE_RATE抽样请求, 记录每个请求的查询次数和总耗时, 按去掉参数后的语句指纹分组:
+    同一个指纹在一个请求里执行超过SQL_PROFILER_N_PLUS_ONE次记为N+1, 打warning
+    响应头SQL_PROFILER_HEADER(默认X-SQL-Profile)带上本请求的统计
+每个进程先在内存里按指纹累加, 每隔flush_interval秒HINCRBY到redis, `flask sql_profile`输出所有worker的汇总。
+"""
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from logging import getLogger
+
+from flask import g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+logger = getLogger(__name__)
+
+_params = r'(?:%s|%\(\w+\)s|\?|:\w+)'
+_literal = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_param = re.compile(_params)
+_param_list = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_rows = re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+')
+_space = re.compile(r'\s+')
+
+_fingerprints = {}
+
+
+def fingerprint(statement):
+    """
+    去掉字面量和参数, IN列表和多行VALUES折叠成一个, 结果按语句缓存
+    """
+    result = _fingerprints.get(statement)
+    if result is None:
+        result = _literal.sub('?', statement)
+        result = _param.sub('?', result)
+        result = _param_list.sub('(?)', result)
+        result = _rows.sub('(?)', result)
+        result = _space.sub(' ', result).strip()
+        if len(_fingerprints) > 4096:
+            _fingerprints.clear()
+        _fingerprints[statement] = result
+    return result
+
+
+class RequestProfile(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.queries = defaultdict(lambda: [0, 0])
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.total += elapsed
+        query = self.queries[fingerprint(statement)]
+        query[0] += 1
+        query[1] += elapsed
+
+    def repeated(self, threshold):
+        return {fp: count for fp, (count, _) in self.queries.items() if count >= threshold}
+
+
+class SqlProfileStats(object):
+    prefix = 'sql:stats:'
+    fingerprints_key = 'sql:stats:fingerprints'
+
+    def __init__(self, redis, flush_interval=10):
+        self.redis = redis
+        self.flush_interval = flush_interval
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._texts = {}
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    @staticmethod
+    def _digest(fp):
+        return hashlib.blake2b(fp.encode('utf8'), digest_size=8).hexdigest()
+
+    def add(self, profile, repeated):
+        with self._lock:
+            for fp, (count, elapsed) in profile.queries.items():
+                digest = self._digest(fp)
+                self._texts[digest] = fp
+                counters = self._counters[digest]
+                counters['count'] += count
+                counters['time_us'] += int(elapsed * 1000000)
+                counters['requests'] += 1
+                if fp in repeated:
+                    counters['n_plus_one'] += 1
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(lambda: defaultdict(int))
+            texts, self._texts = self._texts, {}
+            self._flushed_at = time.monotonic()
+        if not counters:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hset(self.fingerprints_key, mapping=texts)
+            for digest, fields in counters.items():
+                for field, amount in fields.items():
+                    pipe.hincrby(self.prefix + digest, field, amount)
+            pipe.execute()
+        except Exception:
+            logger.exception('SQL统计写入redis失败')
+
+    def report(self, top=20):
+        """
+        按总耗时倒序返回[{fingerprint, count, time_ms, avg_ms, requests, per_request, n_plus_one}]
+        """
+        self.flush()
+        texts = {k.decode('utf8'): v.decode('utf8') for k, v in self.redis.hgetall(self.fingerprints_key).items()}
+        rows = []
+        for digest, fp in texts.items():
+            fields = {k.decode('utf8'): int(v) for k, v in self.redis.hgetall(self.prefix + digest).items()}
+            count, requests = fields.get('count', 0), fields.get('requests', 0)
+            rows.append({
+                'fingerprint': fp,
+                'count': count,
+                'time_ms': round(fields.get('time_us', 0) / 1000, 2),
+                'avg_ms': round(fields.get('time_us', 0) / 1000 / count, 3) if count else None,
+                'requests': requests,
+                'per_request': round(count / requests, 2) if requests else None,
+                'n_plus_one': fields.get('n_plus_one', 0),
+            })
+        return sorted(rows, key=lambda row: row['time_ms'], reverse=True)[:top]
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._texts.clear()
+        keys = list(self.redis.scan_iter(match=f'{self.prefix}*', count=1000))
+        if keys:
+            self.redis.delete(*keys)
+
+
+class SqlProfiler(object):
+    def __init__(self, app=None, engine=None, redis=None):
+        self.stats = None
+        if app is not None:
+            self.init_app(app, engine, redis)
+
+    def init_app(self, app, engine, redis):
+        config = app.config
+        self.sample_rate = config.get('SQL_PROFILER_SAMPLE_RATE', 1.0)
+        self.slow = config.get('SQL_PROFILER_SLOW_MS', 100) / 1000
+        self.n_plus_one = config.get('SQL_PROFILER_N_PLUS_ONE', 5)
+        self.header = config.get('SQL_PROFILER_HEADER', 'X-SQL-Profile')
+        self.stats = SqlProfileStats(redis, config.get('SQL_PROFILER_FLUSH_INTERVAL', 10))
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        logger.info('SQL Profiler Started')
+
+    def _start(self):
+        if random.random() < self.sample_rate:
+            g._sql_profile = RequestProfile()
+
+    @staticmethod
+    def _current():
+        return g.get('_sql_profile') if has_app_context() else None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # 同一个连接上的语句不会嵌套执行, 出错时after_cursor_execute不会触发, 下一条语句直接覆盖
+        conn.info['sql_profiler_start'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('sql_profiler_start', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        if elapsed >= self.slow:
+            path = request.path if has_request_context() else '-'
+            logger.warning(f'慢查询{elapsed * 1000:.1f}ms {path}: {statement} {str(parameters)[:500]}')
+        profile = self._current()
+        if profile is not None:
+            profile.record(statement, elapsed)
+
+    def _finish(self, response):
+        profile = g.pop('_sql_profile', None)
+        if profile is None:
+            return response
+        repeated = profile.repeated(self.n_plus_one)
+        for fp, count in repeated.items():
+            logger.warning(f'疑似N+1 {request.endpoint}: {count}次 {fp}')
+        if self.header:
+            response.headers[self.header] = f'count={profile.count}; time={profile.total * 1000:.1f}ms; ' \
+                                            f'n+1={len(repeated)}'
+        self.stats.add(profile, repeated)
+        return response
+
+
+sql_profiler = SqlProfiler()
@@ -4,21 +4,28 @@ import inspect
 import json
 import logging
 import os
+import random
+import statistics
+import time
 
+import click
 import flask_migrate
-import redis
 import requests
 import shutil
 
 from colorlog import colorlog
-from flask import Flask
+from flask import Flask, abort, jsonify, request
 from flask_principal import identity_loaded
 from flask_session import Session
 from gunicorn.app.base import Application
 
-from app.cache import cache
-from app.database import db
+from app.cache import cache, CacheInvalidationProcessor
+from app.database import AbstractBulkEventsProcessor, AbstractSingleEventsProcessor, EventsProcessorProxy, db
 from app.principal import on_identity_loaded, principal_config
+from app.redis_manager import redis_manager
+from app.redis_session import CompactRedisSessionInterface
+from app.serializer import Serializer
+from app.sql_profiler import sql_profiler
 
 log = logging.getLogger(__name__)
 __all__ = [
@@ -76,6 +83,7 @@ def read_config(module_name: str, config_file=None) -> dict:
 def init_app(app):
     init_logger(app)
     log.info('Base Init App')
+    redis_manager.init_app(app)
     db.init_app(app)
     init_redis_session(app)
     # configure_webargs_error_handler(app)
@@ -85,6 +93,14 @@ def init_app(app):
     # _configure_internal_service(app)
     manager.init_app(app, db)
     cache.init_app(app)
+    if app.config.get('REDIS_CACHE_AUTO_INVALIDATE', False):
+        db.events_processor.add_processors(CacheInvalidationProcessor(
+            cache, retry_max_keys=app.config.get('REDIS_CACHE_INVALIDATE_RETRY_MAX_KEYS', 10000)))
+    if app.config.get('REDIS_CACHE_STATS_URL'):
+        _configure_cache_stats_view(app)
+    if app.config.get('SQL_PROFILER_ON', False):
+        sql_profiler.init_app(app, db.get_engine(app),
+                              redis_manager.get(app.config.get('SQL_PROFILER_REDIS_DB', app.config['REDIS_CACHE_DB'])))
     # permission.init_app(app)
     # internal_rpc.init_app(app)
 
@@ -94,6 +110,16 @@ def init_app(app):
 #     internal_server.init_app(app)
 
 
+def _configure_cache_stats_view(app):
+    def cache_stats():
+        if request.remote_addr not in app.config.get('INTERNAL_HOSTS', []):
+            abort(403)
+        return jsonify(cache.stats.report())
+
+    app.add_url_rule(app.config['REDIS_CACHE_STATS_URL'], endpoint='cache_stats', view_func=cache_stats,
+                     methods=['GET'])
+
+
 def _configure_principal(app):
     principal_config.init_app(app)
     identity_loaded.connect(on_identity_loaded, app)
@@ -162,12 +188,17 @@ def get_formatter():
 
 def init_redis_session(app):
     if app.config.get('SESSION_TYPE') == 'redis':
-        host = app.config['REDIS_HOST']
-        port = app.config.get('REDIS_PORT', 6379)
-        db = app.config.get('REDIS_DB', 0)
-        redis_server = redis.StrictRedis(host=host, port=int(port), db=int(db))
-        app.config['SESSION_REDIS'] = redis_server
+        app.config['SESSION_REDIS'] = redis_manager.get(app.config.get('REDIS_DB', 0))
+        # 默认压缩超过1k的session
+        app.config.setdefault('SESSION_COMPRESS', 'zlib')
         Session(app)
+        # 内容没变不重写session, 只按SESSION_TTL_REFRESH_INTERVAL续期; 旧的pickle session仍然可以读
+        # flask-session的默认值只设置在配置的副本上, 从它建好的session_interface里取
+        interface = app.session_interface
+        app.session_interface = CompactRedisSessionInterface(
+            interface.redis, interface.key_prefix, use_signer=interface.use_signer, permanent=interface.permanent,
+            serializer=Serializer.from_config(app.config, 'SESSION'),
+            refresh_interval=app.config.get('SESSION_TTL_REFRESH_INTERVAL', 60))
 
 
 class Manager(object):
@@ -275,6 +306,100 @@ class Manager(object):
             db.session.remove()
             db.engine.dispose()
 
+        @self.command
+        def cache_sweep():
+            """回收整体失效后的旧版本缓存key"""
+            deleted = cache.sweep()
+            log.info(f'cache sweep deleted {deleted} keys')
+
+        @self.command
+        @click.option('--reset', is_flag=True, help='清空统计')
+        def cache_stats(reset):
+            """按(model, method)输出所有worker汇总的缓存统计"""
+            if not app.config.get('REDIS_CACHE_STATS_ON', False):
+                log.warning('REDIS_CACHE_STATS_ON is off')
+                return
+            if reset:
+                cache.stats.reset()
+                return
+            columns = ['model', 'method', 'hit', 'local_hit', 'miss', 'hit_rate', 'fill_ms_avg', 'fill_ms_p95',
+                       'lock_attempts', 'lock_failures', 'lock_wait_ms_p95', 'size_avg', 'size_p95']
+            print('\t'.join(columns))
+            for row in cache.stats.report():
+                print('\t'.join(str(row[column]) for column in columns))
+
+        @self.command
+        @click.option('--top', default=20, help='按总耗时输出前几条')
+        @click.option('--reset', is_flag=True, help='清空统计')
+        def sql_profile(top, reset):
+            """按语句指纹输出所有worker汇总的SQL统计"""
+            if not app.config.get('SQL_PROFILER_ON', False):
+                log.warning('SQL_PROFILER_ON is off')
+                return
+            if reset:
+                sql_profiler.stats.reset()
+                return
+            columns = ['count', 'time_ms', 'avg_ms', 'requests', 'per_request', 'n_plus_one', 'fingerprint']
+            print('\t'.join(columns))
+            for row in sql_profiler.stats.report(top):
+                print('\t'.join(str(row[column]) for column in columns))
+
+        @self.command
+        @click.option('--name', default='default', help='检查点名字, 不同名字各自处理一遍')
+        @click.option('--batch-size', default=1000)
+        @click.option('--gap-timeout', default=300, help='跳过的id超过这么多秒还没出现, 视为事务已回滚')
+        @click.option('--follow', is_flag=True, help='持续处理')
+        @click.option('--prune', is_flag=True, help='删除已经处理过的行')
+        def events_drain(name, batch_size, gap_timeout, follow, prune):
+            """处理events_outbox里提交的变更"""
+            from app import outbox
+            kwargs = dict(name=name, batch_size=batch_size, gap_timeout=gap_timeout, prune=prune)
+            if follow:
+                outbox.follow(db.events_processor, app, **kwargs)
+            else:
+                log.info(f'outbox processed {outbox.drain(db.events_processor, app, **kwargs)} rows')
+
+        @self.command
+        @click.option('--changes', default=10000, help='每次提交的变更数')
+        @click.option('--models', default=20, help='model的数量, 一半是另一半的子类')
+        @click.option('--duplicates', default=0.1, help='重复修改同一个对象的比例')
+        @click.option('--repeat', default=20)
+        def events_benchmark(changes, models, duplicates, repeat):
+            """测量EventsProcessorProxy分发一次提交的耗时, processor都是空操作"""
+            bases = [type(f'Model{i}', (object,), {}) for i in range(models - models // 2)]
+            classes = bases + [type(f'SubModel{i}', (bases[i % len(bases)],), {}) for i in range(models // 2)]
+
+            class Bulk(AbstractBulkEventsProcessor):
+                def process(self, sender, changes):
+                    pass
+
+            class Single(AbstractSingleEventsProcessor):
+                def _insert(self, sender, obj):
+                    pass
+
+                def _update(self, sender, obj, values_log):
+                    pass
+
+                def _delete(self, sender, obj):
+                    pass
+
+            proxy = EventsProcessorProxy()
+            for Model in bases:
+                bulk, single = Bulk(), Single()
+                bulk.Model = single.Model = Model
+                proxy.add_processors(bulk, single)
+
+            objs = [random.choice(classes)() for _ in range(int(changes * (1 - duplicates)))]
+            batch = [(obj, 'update', {'title': (0, 1)}) for obj in objs]
+            batch += [(random.choice(objs), 'update', {'title': (1, 2)}) for _ in range(changes - len(batch))]
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                proxy.process(app, batch)
+                timings.append((time.perf_counter() - start) * 1000)
+            print(f'{changes} changes, {models} models, {duplicates:.0%} duplicates: '
+                  f'median {statistics.median(timings):.2f}ms, min {min(timings):.2f}ms, max {max(timings):.2f}ms')
+
         @manager.command
         def test():
             import subprocess
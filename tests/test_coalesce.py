@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+from app.database import coalesce_changes
+
+
+class Obj(object):
+    pass
+
+
+class CoalesceChangesTest(unittest.TestCase):
+    def test_distinct_objects_unchanged(self):
+        a, b = Obj(), Obj()
+        changes = [(a, 'insert'), (b, 'update', {'title': ('x', 'y')})]
+        self.assertIs(coalesce_changes(changes), changes)
+
+    def test_insert_then_update_is_insert(self):
+        a = Obj()
+        self.assertEqual(coalesce_changes([(a, 'insert'), (a, 'update', {'title': ('x', 'y')})]), [(a, 'insert')])
+
+    def test_insert_then_delete_is_nothing(self):
+        a, b = Obj(), Obj()
+        self.assertEqual(coalesce_changes([(a, 'insert'), (b, 'update'), (a, 'delete')]), [(b, 'update')])
+
+    def test_update_then_update_merges_values_log(self):
+        a = Obj()
+        changes = [(a, 'update', {'title': ('x', 'y'), 'body': ('b', 'c')}),
+                   (a, 'update', {'title': ('y', 'z')})]
+        self.assertEqual(coalesce_changes(changes), [(a, 'update', {'title': ('x', 'z'), 'body': ('b', 'c')})])
+
+    def test_update_reverted_has_no_values_log(self):
+        a = Obj()
+        changes = [(a, 'update', {'title': ('x', 'y')}), (a, 'update', {'title': ('y', 'x')})]
+        self.assertEqual(coalesce_changes(changes), [(a, 'update')])
+
+    def test_update_then_delete_is_delete(self):
+        a = Obj()
+        self.assertEqual(coalesce_changes([(a, 'update'), (a, 'delete')]), [(a, 'delete')])
+
+    def test_delete_then_insert_is_insert(self):
+        a = Obj()
+        self.assertEqual(coalesce_changes([(a, 'delete'), (a, 'insert')]), [(a, 'insert')])
+
+    def test_insert_delete_insert_is_insert(self):
+        a = Obj()
+        self.assertEqual(coalesce_changes([(a, 'insert'), (a, 'delete'), (a, 'insert')]), [(a, 'insert')])
+
+    def test_keeps_first_seen_order(self):
+        a, b = Obj(), Obj()
+        changes = [(a, 'update'), (b, 'insert'), (a, 'delete')]
+        self.assertEqual(coalesce_changes(changes), [(a, 'delete'), (b, 'insert')])
+
+
+if __name__ == '__main__':
+    unittest.main()
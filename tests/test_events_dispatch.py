@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+
+from app.database import AbstractBulkEventsProcessor, db
+
+
+class DispatchItem(db.Model):
+    __tablename__ = 'test_dispatch_item'
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(50))
+
+
+class RecordingProcessor(AbstractBulkEventsProcessor):
+    Model = DispatchItem
+
+    def __init__(self):
+        self.seen = []
+
+    def process(self, sender, changes):
+        self.seen.extend((change[0].title, change[1]) for change in changes)
+
+
+class AfterCommitBackpressureTest(unittest.TestCase):
+    """
+    没有后台线程, 队列只能放一批: 第二次提交起队列已满, 在提交的请求里处理
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        fd, cls.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        cls.app = Flask(__name__)
+        cls.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + cls.path,
+                              SQLALCHEMY_TRACK_MODIFICATIONS=True,
+                              SQLALCHEMY_EVENTS_DISPATCH='after_commit',
+                              SQLALCHEMY_EVENTS_WORKERS=0,
+                              SQLALCHEMY_EVENTS_QUEUE_SIZE=1,
+                              SQLALCHEMY_EVENTS_PUT_TIMEOUT=0.01,
+                              SQLALCHEMY_EVENTS_RETRY_DELAY=0.01)
+        db.init_app(cls.app)
+        cls.processor = RecordingProcessor()
+        db.events_processor.add_processors(cls.processor)
+        with cls.app.app_context():
+            db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        # 队列里没有线程处理的那一批, 不清掉的话进程退出时要等drain_timeout
+        dispatcher = db.dispatcher
+        while not dispatcher.queue.empty():
+            dispatcher.queue.get_nowait()
+            dispatcher.queue.task_done()
+        os.remove(cls.path)
+
+    def test_queue_full_is_processed_inline(self):
+        with self.app.app_context():
+            db.session.add(DispatchItem(title='queued'))
+            db.session.commit()
+            self.assertEqual(self.processor.seen, [])
+
+            db.session.add(DispatchItem(title='inline'))
+            db.session.commit()
+            self.assertEqual(self.processor.seen, [('inline', 'insert')])
+
+            # 当前线程的session没有被处理过程影响, 还能继续查询和提交
+            self.assertEqual(DispatchItem.query.count(), 2)
+            db.session.add(DispatchItem(title='again'))
+            db.session.commit()
+            self.assertEqual(self.processor.seen, [('inline', 'insert'), ('again', 'insert')])
+            self.assertEqual(DispatchItem.query.count(), 3)
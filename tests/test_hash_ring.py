@@ -0,0 +1,47 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+from app.hash_ring import HashRing
+
+
+class HashRingTest(unittest.TestCase):
+    keys = ['post:g0:%s' % i for i in range(10000)]
+
+    def ring(self, *node_ids):
+        return HashRing({node_id: node_id for node_id in node_ids})
+
+    def test_single_node(self):
+        ring = self.ring('a')
+        self.assertEqual({ring.get_node_id(key) for key in self.keys}, {'a'})
+
+    def test_independent_of_node_order(self):
+        ring, reversed_ring = self.ring('a', 'b', 'c'), self.ring('c', 'b', 'a')
+        self.assertTrue(all(ring.get_node_id(key) == reversed_ring.get_node_id(key) for key in self.keys))
+
+    def test_keys_spread_over_nodes(self):
+        ring = self.ring('a', 'b', 'c', 'd')
+        counts = {}
+        for key in self.keys:
+            node_id = ring.get_node_id(key)
+            counts[node_id] = counts.get(node_id, 0) + 1
+        for count in counts.values():
+            self.assertAlmostEqual(count / len(self.keys), 0.25, delta=0.08)
+
+    def test_adding_node_moves_only_its_share(self):
+        before, after = self.ring('a', 'b', 'c', 'd'), self.ring('a', 'b', 'c', 'd', 'e')
+        moved = [key for key in self.keys if before.get_node_id(key) != after.get_node_id(key)]
+        # 只有约1/5的key换节点, 而且都换到新节点上
+        self.assertAlmostEqual(len(moved) / len(self.keys), 0.2, delta=0.08)
+        self.assertEqual({after.get_node_id(key) for key in moved}, {'e'})
+
+    def test_group(self):
+        ring = self.ring('a', 'b')
+        keys = self.keys[:100]
+        groups = ring.group(keys)
+        self.assertEqual(sorted(index for indexes in groups.values() for index in indexes), list(range(100)))
+        for node_id, indexes in groups.items():
+            self.assertTrue(all(ring.get_node_id(keys[index]) == node_id for index in indexes))
+
+
+if __name__ == '__main__':
+    unittest.main()
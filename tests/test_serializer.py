@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+import pickle
+import unittest
+
+from app import serializer as serializers
+from app.serializer import Serializer
+
+
+class SerializerTest(unittest.TestCase):
+    value = {'title': '标题', 'tags': ['a', 'b'], 'count': 3, 'body': 'x' * 4096}
+
+    def assertRoundTrip(self, serializer, value=None):
+        value = self.value if value is None else value
+        data = serializer.dumps(value)
+        self.assertLess(data[0], 0x80)
+        self.assertEqual(serializers.loads(data), value)
+        return data
+
+    def test_pickle(self):
+        data = self.assertRoundTrip(Serializer('pickle'))
+        self.assertEqual(data[0], serializers.FORMAT_PICKLE)
+
+    def test_json(self):
+        data = self.assertRoundTrip(Serializer('json'))
+        self.assertEqual(data[0], serializers.FORMAT_JSON)
+
+    def test_zlib_compressed_above_threshold(self):
+        data = self.assertRoundTrip(Serializer('json', compress='zlib'))
+        self.assertEqual(data[0], (serializers.COMPRESS_ZLIB << 4) | serializers.FORMAT_JSON)
+        self.assertLess(len(data), len(Serializer('json').dumps(self.value)))
+
+    def test_small_value_not_compressed(self):
+        data = self.assertRoundTrip(Serializer('pickle', compress='zlib'), {'id': 1})
+        self.assertEqual(data[0] >> 4, serializers.COMPRESS_NONE)
+
+    @unittest.skipIf(serializers.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        self.assertRoundTrip(Serializer('msgpack'))
+
+    @unittest.skipIf(serializers.lz4 is None, 'lz4 is not installed')
+    def test_lz4(self):
+        data = self.assertRoundTrip(Serializer('pickle', compress='lz4'))
+        self.assertEqual(data[0] >> 4, serializers.COMPRESS_LZ4)
+
+    def test_legacy_pickle(self):
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.dumps(self.value, protocol=protocol)
+            self.assertEqual(data[0], 0x80)
+            self.assertEqual(serializers.loads(data), self.value)
+
+    def test_formats_read_together(self):
+        values = [Serializer('pickle').dumps(1), Serializer('json', compress='zlib').dumps(self.value),
+                  pickle.dumps([1, 2])]
+        self.assertEqual([serializers.loads(data) for data in values], [1, self.value, [1, 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()